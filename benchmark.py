@@ -0,0 +1,333 @@
+import pandas as pd
+import numpy as np
+import argparse
+import json
+import matplotlib
+import multiprocessing
+import os
+import platform
+import sklearn
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations, islice
+from scipy import stats
+from sklearn.base import clone
+from intraday import BUCKET, RV_WINDOW, bucket_reddit, join_activity, realized_volatility
+from leadlag import lead_lag
+from merge_clean import EWMA_LAMBDA, RANGE_WINDOW, VOL_WINDOWS, add_volatility_features, merge_reddit
+from profiling import records, reset, section
+from resampling import resample_correlations
+from sentiment import SentimentScorer
+from statistical_tests import PAIR_METRICS, run_battery
+from storage import read_table, table_size, write_table
+from train import FEATURE_COLS, MODELS
+
+
+def synthetic_dataset(n_tickers, days=500, seed=0):
+    """Random daily rows shaped like merge_cleaned/dataset for `n_tickers` tickers."""
+    rng = np.random.default_rng(seed)
+    n = n_tickers * days
+    return pd.DataFrame({
+        'Date': np.tile(pd.bdate_range('2020-01-01', periods=days).values, n_tickers),
+        'ticker': np.repeat([f'T{i:05d}' for i in range(n_tickers)], days),
+        'Close': rng.lognormal(3, 0.5, n),
+        'Volume': rng.integers(1e5, 1e8, n),
+        'vol_5d': rng.gamma(2, 0.02, n),
+        'high_vol': rng.integers(0, 2, n),
+        'mentioned_on_reddit': rng.integers(0, 2, n),
+        'mention_count': rng.poisson(3, n),
+        'avg_sentiment': rng.uniform(-1, 1, n),
+    })
+
+
+def synthetic_prices(n_tickers, days=500, seed=0):
+    """Random-walk OHLCV bars shaped like scrape_stock/prices for `n_tickers` tickers."""
+    rng = np.random.default_rng(seed)
+    n = n_tickers * days
+    close = 20 * np.exp(np.cumsum(rng.normal(0, 0.03, (n_tickers, days)), axis=1)).ravel()
+    open_ = close * np.exp(rng.normal(0, 0.01, n))
+    return pd.DataFrame({
+        'Date': np.tile(pd.bdate_range('2020-01-01', periods=days).values, n_tickers),
+        'ticker': np.repeat([f'T{i:05d}' for i in range(n_tickers)], days),
+        'Open': open_,
+        'High': np.maximum(open_, close) * np.exp(rng.gamma(2, 0.005, n)),
+        'Low': np.minimum(open_, close) * np.exp(-rng.gamma(2, 0.005, n)),
+        'Close': close,
+        'Volume': rng.integers(1e5, 1e8, n),
+    })
+
+
+# words the synthetic reddit texts are made of, with a few that VADER scores
+WORDS = ['the', 'stock', 'is', 'going', 'to', 'moon', 'calls', 'puts', 'hold', 'sell', 'buy', 'today',
+         'great', 'love', 'amazing', 'bad', 'terrible', 'crash', 'scam', 'rocket', 'lol', 'shares']
+
+
+def synthetic_reddit(n_tickers, days=500, seed=0, mention_rate=0.5, texts_per_ticker=5):
+    """Random scrape_stock/reddit_daily rows plus a few post/comment texts per ticker to score."""
+    rng = np.random.default_rng(seed + 1)
+    dates = pd.bdate_range('2020-01-01', periods=days).values
+    mentioned = rng.random((n_tickers, days)) < mention_rate
+    t_idx, d_idx = np.nonzero(mentioned)
+    daily = pd.DataFrame({
+        'date': dates[d_idx],
+        'ticker': np.array([f'T{i:05d}' for i in range(n_tickers)])[t_idx],
+        'mention_count': rng.poisson(3, len(t_idx)) + 1,
+        'avg_sentiment': rng.uniform(-1, 1, len(t_idx)),
+    })
+    lengths = rng.integers(5, 40, n_tickers * texts_per_ticker)
+    words = rng.choice(WORDS, lengths.sum())
+    texts = [' '.join(w) for w in np.split(words, np.cumsum(lengths)[:-1])]
+    return daily, texts
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def bench_storage(n_tickers=1000, days=500):
+    """Compare the old csv round trip with the parquet storage layer on the same data."""
+    data = synthetic_dataset(n_tickers, days)
+    tickers = sorted(data['ticker'].unique())[:10]
+    columns = ['vol_5d', 'mention_count']
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, 'dataset.csv')
+        pq_path = os.path.join(tmp, 'dataset')
+
+        csv_write, _ = timed(lambda: data.to_csv(csv_path, index=False))
+        pq_write, _ = timed(lambda: write_table(data, pq_path))
+
+        def load_csv():
+            # what every stage used to do: parse everything, then fix the types
+            df = pd.read_csv(csv_path)
+            df['Date'] = pd.to_datetime(df['Date'])
+            return df
+
+        def load_csv_subset():
+            df = load_csv()
+            return df[df['ticker'].isin(tickers)][['ticker'] + columns]
+
+        results = [
+            ('write', csv_write, pq_write),
+            ('full load', timed(load_csv)[0], timed(lambda: read_table(pq_path))[0]),
+            ('10 tickers, 2 columns', timed(load_csv_subset)[0],
+             timed(lambda: read_table(pq_path, columns=columns, tickers=tickers))[0]),
+        ]
+        csv_size = table_size(csv_path)
+        pq_size = table_size(pq_path)
+
+    print(f'{n_tickers} tickers x {days} days ({len(data)} rows)')
+    for name, csv_time, pq_time in results:
+        print(f'{name:>22}: csv {csv_time:.2f}s, parquet {pq_time:.2f}s ({csv_time / pq_time:.1f}x)')
+    print(f'{"size on disk":>22}: csv {csv_size / 1e6:.1f}MB, parquet {pq_size / 1e6:.1f}MB ({csv_size / pq_size:.1f}x)')
+
+
+def bench_features(n_tickers=1000, days=500):
+    """Per-ticker lambdas (the old merge_clean approach) against the vectorized engine."""
+    prices = synthetic_prices(n_tickers, days)
+
+    def old_features():
+        df = prices.sort_values(['ticker', 'Date'])
+        by_ticker = df.groupby('ticker')
+        df['ret'] = by_ticker['Close'].pct_change()
+        df['vol_5d'] = by_ticker['ret'].transform(lambda x: x.rolling(5).std())
+        old_5d = time.perf_counter()
+        # the remaining estimators written the same way, to compare like with like
+        for w in VOL_WINDOWS[1:]:
+            df[f'vol_{w}d'] = by_ticker['ret'].transform(lambda x: x.rolling(w).std())
+        hl = np.log(df['High'] / df['Low']) ** 2
+        co = np.log(df['Close'] / df['Open']) ** 2
+        df['parkinson'] = np.sqrt(hl.groupby(df['ticker']).transform(lambda x: x.rolling(RANGE_WINDOW).mean()) / (4 * np.log(2)))
+        gk = 0.5 * hl - (2 * np.log(2) - 1) * co
+        df['garman_klass'] = np.sqrt(gk.groupby(df['ticker']).transform(lambda x: x.rolling(RANGE_WINDOW).mean()))
+        df['ewma_vol'] = np.sqrt((df['ret'] ** 2).groupby(df['ticker']).transform(
+            lambda x: x.ewm(alpha=1 - EWMA_LAMBDA, adjust=False).mean()))
+        return old_5d
+
+    start = time.perf_counter()
+    old_5d = old_features()
+    old_time = time.perf_counter() - start
+    old_5d_time = old_5d - start
+    new_time, _ = timed(lambda: add_volatility_features(prices))
+    print(f'{n_tickers} tickers x {days} days ({len(prices)} rows)')
+    print(f'old lambdas, vol_5d only:    {old_5d_time:.2f}s')
+    print(f'old lambdas, all estimators: {old_time:.2f}s')
+    print(f'vectorized, all estimators:  {new_time:.2f}s ({old_time / new_time:.1f}x faster)')
+
+
+def bench_stats(n_tickers=200, days=500, sample_pairs=500):
+    """A scipy loop over ticker pairs (timed on a sample, then scaled up) against the batched battery."""
+    data = synthetic_dataset(n_tickers, days)
+    by_ticker = {t: g for t, g in data.groupby('ticker')}
+    n_pairs = n_tickers * (n_tickers - 1) // 2
+    pairs = list(islice(combinations(sorted(by_ticker), 2), sample_pairs))
+
+    def scipy_pairs():
+        for a, b in pairs:
+            for metric in PAIR_METRICS:
+                x, y = by_ticker[a][metric], by_ticker[b][metric]
+                stats.levene(x, y)
+                stats.mannwhitneyu(x, y)
+
+    loop_time = timed(scipy_pairs)[0] * n_pairs / len(pairs)
+    new_time, results = timed(lambda: run_battery(data))
+    print(f'{n_tickers} tickers x {days} days ({n_pairs} pairs, {len(results)} tests)')
+    print(f'scipy loop over pairs (est. from {len(pairs)}): {loop_time:.2f}s')
+    print(f'batched battery: {new_time:.2f}s ({loop_time / new_time:.1f}x faster)')
+
+
+def synthetic_minute_bars(n_tickers, days=5, seed=0):
+    """Random-walk 1 minute bars for a full regular session (390 bars a day) per ticker and day."""
+    rng = np.random.default_rng(seed)
+    session = pd.timedelta_range('14:30:00', periods=390, freq='1min')
+    times = (pd.bdate_range('2024-01-01', periods=days).values[:, None] + session.values).ravel()
+    n = n_tickers * len(times)
+    return pd.DataFrame({
+        'Datetime': np.tile(times, n_tickers),
+        'ticker': np.repeat([f'T{i:05d}' for i in range(n_tickers)], len(times)),
+        'Close': (20 * np.exp(np.cumsum(rng.normal(0, 1e-3, (n_tickers, len(times))), axis=1))).ravel().astype('float32'),
+        'Volume': rng.integers(100, 10000, n).astype('float32'),
+    })
+
+
+def bench_intraday(n_tickers=1000, days=5, bucket=BUCKET, window=RV_WINDOW):
+    """Per-ticker resample/rolling with default dtypes against the vectorized intraday kernels."""
+    bars = synthetic_minute_bars(n_tickers, days)
+    n_posts = n_tickers * days * 50
+    rng = np.random.default_rng(0)
+    start = bars['Datetime'].min().value / 1e9 - 86400
+    raw = pd.DataFrame({
+        'ticker': rng.choice(bars['ticker'].unique(), n_posts),
+        'created_utc': start + rng.uniform(0, (days + 2) * 86400, n_posts),
+        'sentiment': rng.uniform(-1, 1, n_posts),
+    })
+
+    def old_intraday():
+        df = bars.astype({'Close': float, 'Volume': float}).sort_values(['ticker', 'Datetime'])
+        df['r2'] = np.log(df['Close']).groupby(df['ticker']).diff() ** 2
+        rv = df.set_index('Datetime').groupby('ticker')['r2'].resample(bucket).sum(min_count=1).dropna().reset_index()
+        rv[f'rv_{window}'] = np.sqrt(rv.groupby('ticker')['r2'].transform(lambda x: x.rolling(window).sum()))
+        posts = raw.assign(Datetime=pd.to_datetime(raw['created_utc'], unit='s').dt.floor(bucket) + pd.Timedelta(bucket))
+        activity = posts.groupby(['ticker', 'Datetime'])['sentiment'].agg(['mean', 'count']).reset_index()
+        return rv.merge(activity, on=['ticker', 'Datetime'], how='left')
+
+    def new_intraday():
+        return join_activity(realized_volatility(bars, bucket, window), bucket_reddit(raw, bucket), bucket)
+
+    old_time, old = timed(old_intraday)
+    new_time, new = timed(new_intraday)
+    print(f'{n_tickers} tickers x {days} days ({len(bars)} minute bars, {n_posts} posts, {bucket} buckets)')
+    print(f'per-ticker resample/rolling: {old_time:.2f}s, {old.memory_usage(deep=True).sum() / 1e6:.0f}MB result')
+    print(f'vectorized kernels:          {new_time:.2f}s, {new.memory_usage(deep=True).sum() / 1e6:.0f}MB result '
+          f'({old_time / new_time:.1f}x faster)')
+
+
+# scaling suite: every hot stage kernel on synthetic data of increasing size
+SUITE_SIZES = [10, 100, 1000, 10000]
+# pairwise tests grow with tickers^2, so they stop at this many tickers
+SUITE_MAX_PAIR_TICKERS = 1000
+SUITE_PLOT_TICKERS = 10
+SUITE_RESAMPLES = 200
+
+
+def _suite_size(n_tickers, days, seed):
+    """Run every kernel once for one size, in a fresh process, and return its profiling records."""
+    matplotlib.use('Agg')
+    from visuals import plot_ticker
+    reset()
+    prices = synthetic_prices(n_tickers, days, seed)
+    reddit, texts = synthetic_reddit(n_tickers, days, seed)
+
+    with section('features', rows=len(prices)):
+        prices = add_volatility_features(prices)
+    with section('merge', rows=len(prices)):
+        dataset = merge_reddit(prices, reddit).dropna(subset=['vol_5d'])
+        dataset['high_vol'] = (dataset['vol_5d'] > dataset.groupby('ticker')['vol_5d'].transform('quantile', 0.75)).astype(int)
+    with tempfile.TemporaryDirectory() as tmp:
+        with section('storage.write', rows=len(dataset)):
+            write_table(dataset, os.path.join(tmp, 'dataset'))
+        with section('storage.read', rows=len(dataset)):
+            read_table(os.path.join(tmp, 'dataset'), columns=['Date', 'vol_5d', 'mention_count'])
+    with section('sentiment', rows=len(texts)):
+        SentimentScorer(workers=1).score(texts)
+    if n_tickers <= SUITE_MAX_PAIR_TICKERS:
+        with section('stats', rows=len(dataset)):
+            run_battery(dataset, workers=1)
+    with section('resampling', rows=len(dataset)):
+        resample_correlations(dataset, n_resamples=SUITE_RESAMPLES, workers=1, seed=seed)
+    with section('leadlag', rows=len(dataset)):
+        lead_lag(dataset)
+    with section('train.fit', rows=len(dataset)):
+        clone(MODELS['logistic']).fit(dataset[FEATURE_COLS].to_numpy(), dataset['high_vol'].to_numpy())
+    plot_tickers = sorted(dataset['ticker'].unique())[:SUITE_PLOT_TICKERS]
+    with section('plot', rows=len(plot_tickers)), tempfile.TemporaryDirectory() as tmp:
+        for ticker, group in dataset[dataset['ticker'].isin(plot_tickers)].groupby('ticker'):
+            plot_ticker(ticker, group, tmp)
+    return [{'tickers': n_tickers, 'days': days, **rec} for rec in records()]
+
+
+def run_suite(sizes=SUITE_SIZES, days=250, seed=0, output='stats/benchmark_suite.json', compare=None):
+    """Time every kernel at each size and write the results (plus the environment) as json.
+
+    Each size runs in its own spawned process, so peak RSS is per size instead of the largest
+    so far. Data comes from fixed seeds, so runs on the same machine are comparable. With
+    `compare`, wall times are also shown relative to an earlier results file.
+    """
+    results = []
+    for n_tickers in sizes:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            rows = pool.submit(_suite_size, n_tickers, days, seed).result()
+        results.extend(rows)
+        for rec in rows:
+            print(f'{n_tickers:>6} tickers  {rec["name"]:<16} {rec["wall_s"]:>9.3f}s  cpu {rec["cpu_s"]:>8.3f}s  '
+                  f'peak {rec["process_peak_rss_mb"]:>7.0f}MB  {rec["rows"]:>9} rows')
+
+    report = {
+        'meta': {
+            'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'sklearn': sklearn.__version__,
+            'sizes': list(sizes), 'days': days, 'seed': seed, 'run_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'results saved to {output}')
+
+    if compare:
+        with open(compare) as f:
+            old = {(r['name'], r['tickers']): r['wall_s'] for r in json.load(f)['results']}
+        print(f'wall time vs {compare} (>1 is slower now):')
+        for rec in results:
+            base = old.get((rec['name'], rec['tickers']))
+            if base:
+                print(f'{rec["tickers"]:>6} tickers  {rec["name"]:<16} {rec["wall_s"] / base:>6.2f}x')
+    return report
+
+
+BENCHMARKS = {
+    'storage': bench_storage,
+    'features': bench_features,
+    'stats': bench_stats,
+    'intraday': bench_intraday,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS) + ['suite'])
+    parser.add_argument('--tickers', type=int, default=1000)
+    parser.add_argument('--days', type=int)
+    # suite only: ticker counts to run, where to save the json and an earlier json to compare with
+    parser.add_argument('--sizes', type=int, nargs='+', default=SUITE_SIZES)
+    parser.add_argument('--output', default='stats/benchmark_suite.json')
+    parser.add_argument('--compare')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if args.benchmark == 'suite':
+        run_suite(args.sizes, days=args.days or 250, seed=args.seed, output=args.output, compare=args.compare)
+    else:
+        # each benchmark has its own default length (intraday is 5 days of minute bars)
+        BENCHMARKS[args.benchmark](n_tickers=args.tickers, **({'days': args.days} if args.days else {}))
@@ -0,0 +1,260 @@
+import pandas as pd
+import numpy as np
+import argparse
+import os
+from merge_clean import cumulative, rolling_sum
+from prices import FixtureProvider, YFinanceProvider
+from profiling import profile_stage, section
+from storage import list_partitions, read_table, write_table
+
+# intraday mode: realized volatility from minute bars next to the reddit activity that came before
+# it, on a grid of fixed time buckets (e.g. 5min or 1h) instead of trading days.
+# all timestamps are UTC without a timezone, like reddit's created_utc (yfinance's New York times are converted)
+# reference: https://en.wikipedia.org/wiki/Realized_variance
+# reference: https://pandas.pydata.org/docs/reference/api/pandas.merge_asof.html
+BUCKET = '5min'
+# buckets in the rolling realized volatility (12 x 5min = the last hour of trading)
+RV_WINDOW = 12
+# a longer gap between two bars starts a new session, so the overnight move isn't a minute return
+SESSION_GAP = np.timedelta64(1, 'h')
+# yfinance keeps 1m bars for the last 30 days and serves at most 8 days per request
+MAX_REQUEST_DAYS = 7
+# tickers processed at once, memory is bounded by one chunk's minute bars
+TICKER_CHUNK = 50
+
+BAR_PATH = 'scrape_stock/minute_bars'
+REDDIT_PATH = 'scrape_stock/reddit_raw'
+OUTPUT_PATH = 'merge_cleaned/intraday'
+BAR_COLS = ['Datetime', 'ticker', 'Open', 'High', 'Low', 'Close', 'Volume']
+# ~400x more rows than the daily tables, so prices and volumes are kept as float32
+# (quotes have fewer than 7 significant digits; returns and sums are still done in float64)
+BAR_DTYPES = {'Open': 'float32', 'High': 'float32', 'Low': 'float32', 'Close': 'float32', 'Volume': 'float32'}
+
+
+def fetch_minute_bars(tickers, start, end, provider=None):
+    """Minute bars for every ticker in [start, end), requested MAX_REQUEST_DAYS at a time."""
+    provider = provider or YFinanceProvider(interval='1m')
+    frames = []
+    cursor = pd.Timestamp(start)
+    while cursor < pd.Timestamp(end):
+        stop = min(cursor + pd.Timedelta(days=MAX_REQUEST_DAYS), pd.Timestamp(end))
+        print(f'downloading minute bars for {len(tickers)} tickers, {cursor:%Y-%m-%d} to {stop:%Y-%m-%d}')
+        frames.append(provider.download(tickers, cursor.strftime('%Y-%m-%d'), stop.strftime('%Y-%m-%d')))
+        cursor = stop
+    bars = pd.concat(frames, ignore_index=True).rename(columns={'Date': 'Datetime'})
+    bars['Datetime'] = pd.to_datetime(bars['Datetime'], utc=True).dt.tz_localize(None)
+    return bars.dropna(subset=['Close']).astype(BAR_DTYPES)[BAR_COLS]
+
+
+def update_minute_bars(tickers, start, end, provider=None, chunk=TICKER_CHUNK):
+    """Add newly fetched bars to scrape_stock/minute_bars, keeping the ones yfinance no longer serves.
+
+    Works `chunk` tickers at a time, so only one chunk's stored bars are in memory.
+    """
+    rows = 0
+    for i in range(0, len(tickers), chunk):
+        part = list(tickers[i:i + chunk])
+        bars = fetch_minute_bars(part, start, end, provider)
+        if os.path.isdir(BAR_PATH):
+            bars = pd.concat([read_table(BAR_PATH, tickers=part), bars], ignore_index=True)
+        bars = bars.drop_duplicates(subset=['Datetime', 'ticker'], keep='last')
+        write_table(bars, BAR_PATH, mode='replace')
+        rows += len(bars)
+    return rows
+
+
+def bucket_starts(times, bucket):
+    """Start of the `bucket` (e.g. '5min') each datetime64 value falls in, on a grid starting at the epoch."""
+    step = pd.Timedelta(bucket).value
+    return (times.astype('datetime64[ns]').view('int64') // step * step).view('datetime64[ns]')
+
+
+def realized_volatility(bars, bucket=BUCKET, window=RV_WINDOW):
+    """Realized volatility per (ticker, bucket) from minute bars, for every ticker at once.
+
+    rv is the square root of the bucket's summed squared log returns, rv_<window> the same over
+    the last `window` buckets that had bars (rolling sums as in merge_clean) and rv_next the
+    next bucket's rv, the value to predict. Returns are never taken across tickers or session gaps.
+    """
+    codes, tickers = pd.factorize(bars['ticker'], sort=True)
+    times = bars['Datetime'].to_numpy(dtype='datetime64[ns]')
+    order = np.lexsort((times, codes))
+    codes, times = codes[order], times[order]
+    close = bars['Close'].to_numpy(dtype=float)[order]
+    volume = bars['Volume'].to_numpy(dtype=float)[order]
+
+    ret = np.full(len(close), np.nan)
+    ret[1:] = np.log(close[1:] / close[:-1])
+    new_session = np.ones(len(close), dtype=bool)
+    new_session[1:] = (codes[1:] != codes[:-1]) | (times[1:] - times[:-1] > SESSION_GAP)
+    ret[new_session] = np.nan
+
+    # bars are sorted by ticker and time, so each bucket is one run of rows: reduce every run at once
+    starts = bucket_starts(times, bucket)
+    first = np.ones(len(close), dtype=bool)
+    first[1:] = (codes[1:] != codes[:-1]) | (starts[1:] != starts[:-1])
+    idx = np.flatnonzero(first)
+    has_ret = ~np.isnan(ret)
+    rv_sq = np.add.reduceat(np.where(has_ret, ret ** 2, 0.0), idx) if len(idx) else np.empty(0)
+    n_ret = np.add.reduceat(has_ret.astype(int), idx) if len(idx) else np.empty(0, dtype=int)
+    bucket_codes = codes[idx]
+
+    # position of each bucket inside its ticker, for the rolling window and the next bucket
+    pos = np.arange(len(idx))
+    new_ticker = np.ones(len(idx), dtype=bool)
+    new_ticker[1:] = bucket_codes[1:] != bucket_codes[:-1]
+    group_pos = pos - np.maximum.accumulate(np.where(new_ticker, pos, 0))
+    rv = np.where(n_ret > 0, np.sqrt(rv_sq), np.nan)
+    rv_next = np.full(len(idx), np.nan)
+    rv_next[:-1] = rv[1:]
+    rv_next[np.flatnonzero(new_ticker)[1:] - 1] = np.nan
+
+    return pd.DataFrame({
+        'Datetime': starts[idx],
+        'ticker': np.asarray(tickers)[bucket_codes],
+        'Close': close[np.append(idx[1:], len(close)) - 1].astype('float32'),
+        'Volume': (np.add.reduceat(volume, idx) if len(idx) else np.empty(0)).astype('float32'),
+        'n_bars': np.diff(np.append(idx, len(close))).astype('int32'),
+        'rv': rv.astype('float32'),
+        f'rv_{window}': np.sqrt(rolling_sum(cumulative(rv_sq), group_pos, window)).astype('float32'),
+        'rv_next': rv_next.astype('float32'),
+    })
+
+
+def bucket_reddit(raw, bucket=BUCKET):
+    """Mention count and sentiment sum per (ticker, bucket) from the raw posts/comments table."""
+    seconds = raw['created_utc'].to_numpy(dtype=float)
+    frame = pd.DataFrame({
+        'ticker': raw['ticker'].to_numpy(),
+        'Datetime': bucket_starts((seconds * 1e9).astype('int64').view('datetime64[ns]'), bucket),
+        'sentiment': raw['sentiment'].to_numpy(dtype=float),
+    })
+    activity = frame.groupby(['ticker', 'Datetime'], sort=True)['sentiment'].agg(['sum', 'count']).reset_index()
+    return activity.rename(columns={'sum': 'sentiment_sum', 'count': 'mention_count'})
+
+
+def join_activity(rv, activity, bucket=BUCKET):
+    """Attach to every price bucket the reddit activity posted since the ticker's previous price bucket.
+
+    Only finished reddit buckets count, so nothing from inside the price bucket leaks in, and
+    activity from nights and weekends lands on the next bucket with bars. Running totals of the
+    activity are looked up with two sorted as-of merges (at this and at the previous bucket start)
+    and their difference is what arrived in between.
+
+    A ticker's first price bucket has no previous one, so it only gets the one reddit bucket
+    before it; older activity has nothing to be attached to and is left out (see early_activity).
+    """
+    step = pd.Timedelta(bucket)
+    totals = activity.assign(available=activity['Datetime'] + step).sort_values(['ticker', 'available'])
+    by_ticker = totals.groupby('ticker', sort=False)
+    totals['cum_count'] = by_ticker['mention_count'].cumsum()
+    totals['cum_sentiment'] = by_ticker['sentiment_sum'].cumsum()
+    totals = totals.sort_values('available', kind='stable')[['available', 'ticker', 'cum_count', 'cum_sentiment']]
+    # as-of merges need the same dtype on both sides of `by`
+    totals['ticker'] = totals['ticker'].astype(str)
+
+    rv = rv.sort_values(['ticker', 'Datetime'], ignore_index=True)
+    rv['ticker'] = rv['ticker'].astype(str)
+    previous = rv.groupby('ticker', sort=False)['Datetime'].shift(1).fillna(rv['Datetime'] - step)
+
+    def totals_at(times):
+        # merge_asof wants the left side in time order: sort the int64 times, then scatter the results back
+        times = times.to_numpy(dtype='datetime64[ns]')
+        order = np.argsort(times, kind='stable')
+        left = pd.DataFrame({'t': times[order], 'ticker': rv['ticker'].to_numpy()[order]})
+        found = pd.merge_asof(left, totals, left_on='t', right_on='available', by='ticker', direction='backward')
+        count, sentiment = np.empty(len(rv)), np.empty(len(rv))
+        count[order] = found['cum_count'].fillna(0).to_numpy()
+        sentiment[order] = found['cum_sentiment'].fillna(0).to_numpy()
+        return count, sentiment
+
+    count_now, sentiment_now = totals_at(rv['Datetime'])
+    count_before, sentiment_before = totals_at(previous)
+    count = count_now - count_before
+    sentiment = sentiment_now - sentiment_before
+    rv['mention_count'] = count.astype('int32')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rv['avg_sentiment'] = np.where(count > 0, sentiment / count, 0.0).astype('float32')
+    rv['mentioned_on_reddit'] = (count > 0).astype('int8')
+    return rv
+
+
+def early_activity(rv, activity, bucket=BUCKET):
+    """Mentions from before the one reddit bucket that a ticker's first price bucket looks back on."""
+    first = rv.groupby('ticker')['Datetime'].min() - pd.Timedelta(bucket)
+    bound = activity['ticker'].map(first)
+    return int(activity.loc[activity['Datetime'] < bound, 'mention_count'].sum())
+
+
+def build_chunk(tickers, bucket=BUCKET, window=RV_WINDOW):
+    """Intraday table for `tickers` and the number of mentions older than their minute bars."""
+    bars = read_table(BAR_PATH, columns=['Datetime', 'Close', 'Volume'], tickers=tickers)
+    if os.path.isdir(REDDIT_PATH) or os.path.exists(REDDIT_PATH + '.csv'):
+        raw = read_table(REDDIT_PATH, columns=['created_utc', 'sentiment'], tickers=tickers)
+    else:
+        raw = pd.DataFrame({'ticker': pd.Series(dtype=str), 'created_utc': pd.Series(dtype=float),
+                            'sentiment': pd.Series(dtype=float)})
+    with section('intraday.realized_vol', rows=len(bars)):
+        rv = realized_volatility(bars, bucket, window)
+    activity = bucket_reddit(raw, bucket)
+    with section('intraday.join', rows=len(raw)):
+        return join_activity(rv, activity, bucket), early_activity(rv, activity, bucket)
+
+
+def main(tickers=None, bucket=BUCKET, window=RV_WINDOW, chunk=TICKER_CHUNK, fetch=False, days=MAX_REQUEST_DAYS,
+         start=None, end=None, bars_fixture=None, csv=False):
+    os.makedirs('merge_cleaned', exist_ok=True)
+
+    if fetch:
+        # tickers default to the ones in the daily price table
+        fetch_tickers = tickers or list_partitions('scrape_stock/prices')
+        end = pd.Timestamp(end) if end else pd.Timestamp.now().normalize() + pd.Timedelta(days=1)
+        start = pd.Timestamp(start) if start else end - pd.Timedelta(days=days)
+        provider = FixtureProvider(bars_fixture) if bars_fixture else None
+        with section('intraday.fetch') as s:
+            s.rows = update_minute_bars(fetch_tickers, start, end, provider, chunk)
+        print('finished minute bars')
+
+    # one chunk of tickers at a time, each appended as its own partitions
+    tickers = sorted(tickers or list_partitions(BAR_PATH))
+    corrs, rows, early = [], 0, 0
+    for i in range(0, len(tickers), chunk):
+        data, dropped = build_chunk(tickers[i:i + chunk], bucket, window)
+        early += dropped
+        with section('intraday.write', rows=len(data)):
+            write_table(data, OUTPUT_PATH, mode='overwrite' if i == 0 else 'append')
+        rows += len(data)
+        for ticker, group in data.groupby('ticker'):
+            if group['mention_count'].std() > 0 and group['rv_next'].std() > 0:
+                corrs.append(group['mention_count'].corr(group['rv_next']))
+    if csv:
+        read_table(OUTPUT_PATH).to_csv(OUTPUT_PATH + '.csv', index=False)
+
+    # print results
+    print(f'{rows} {bucket} buckets for {len(tickers)} tickers saved to {OUTPUT_PATH}')
+    if early:
+        print(f'{early} mentions from before the first minute bars were left out')
+    if corrs:
+        print(f'mention_count vs next bucket rv: median correlation {np.median(corrs):.3f} over {len(corrs)} tickers')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    # defaults to every ticker with minute bars
+    parser.add_argument('--tickers', nargs='+')
+    # bucket size as a pandas offset, e.g. 5min, 15min, 1h
+    parser.add_argument('--bucket', default=BUCKET)
+    parser.add_argument('--window', type=int, default=RV_WINDOW)
+    parser.add_argument('--chunk', type=int, default=TICKER_CHUNK)
+    # download minute bars first (last --days days, or --start/--end), added to scrape_stock/minute_bars
+    parser.add_argument('--fetch', action='store_true')
+    parser.add_argument('--days', type=int, default=MAX_REQUEST_DAYS)
+    parser.add_argument('--start')
+    parser.add_argument('--end')
+    # read minute bars from a local parquet/csv file (Date = bar time) instead of yfinance
+    parser.add_argument('--bars-fixture')
+    # also export merge_cleaned/intraday.csv next to the parquet folder
+    parser.add_argument('--csv', action='store_true')
+    args = parser.parse_args()
+    with profile_stage('intraday'):
+        main(tickers=args.tickers, bucket=args.bucket, window=args.window, chunk=args.chunk, fetch=args.fetch,
+             days=args.days, start=args.start, end=args.end, bars_fixture=args.bars_fixture, csv=args.csv)
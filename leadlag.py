@@ -0,0 +1,181 @@
+import pandas as pd
+import numpy as np
+from scipy import stats
+import argparse
+import os
+from merge_clean import sort_by_ticker
+from profiling import profile_stage, section
+from storage import read_table
+
+# does reddit activity move before volatility does?
+DRIVERS = ['mention_count', 'avg_sentiment']
+TARGET = 'vol_5d'
+# lags are in trading days (rows of a ticker)
+MAX_LAG = 10
+GRANGER_LAGS = [1, 2, 3, 5]
+# tickers handled per batch, bounds the (tickers, days, regressors) design arrays
+TICKER_CHUNK = 256
+
+
+def to_panel(data, cols):
+    """One (tickers, days) array per column, tickers sorted and each row left-aligned in date order.
+
+    Shorter tickers are padded with NaN at the end.
+    """
+    data, group_pos = sort_by_ticker(data)
+    codes, tickers = pd.factorize(data['ticker'], sort=True)
+    width = group_pos.max() + 1 if len(data) else 0
+    panel = {}
+    for col in cols:
+        values = np.full((len(tickers), width), np.nan)
+        values[codes, group_pos] = data[col].to_numpy(dtype=float)
+        panel[col] = values
+    return np.asarray(tickers), panel
+
+
+def cross_correlations(x, y, max_lag=MAX_LAG):
+    """Cross-correlation corr(x[t], y[t + k]) for k = -max_lag..max_lag, for every row at once.
+
+    Same estimator as statsmodels' ccf: products summed over the overlap and divided by n and
+    both standard deviations. NaNs are left out (set to 0 after removing the mean). All lags
+    come from one real FFT per row instead of a loop over lags.
+    reference: https://numpy.org/doc/stable/reference/routines.fft.html (correlation by FFT)
+    reference: https://www.statsmodels.org/stable/generated/statsmodels.tsa.stattools.ccf.html
+    """
+    valid = ~np.isnan(x) & ~np.isnan(y)
+    n = valid.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xc = np.where(valid, x - np.nanmean(np.where(valid, x, np.nan), axis=1, keepdims=True), 0.0)
+        yc = np.where(valid, y - np.nanmean(np.where(valid, y, np.nan), axis=1, keepdims=True), 0.0)
+        scale = np.sqrt((xc ** 2).sum(axis=1) * (yc ** 2).sum(axis=1))
+    # zero padding to at least 2 * width keeps the circular correlation from wrapping around
+    nfft = 1 << int(np.ceil(np.log2(max(2 * x.shape[1], 2))))
+    raw = np.fft.irfft(np.conj(np.fft.rfft(xc, nfft)) * np.fft.rfft(yc, nfft), nfft)
+    # raw[:, k] is sum over t of x[t] * y[t + k], negative k wrap to the end
+    lags = np.arange(-max_lag, max_lag + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ccf = raw[:, lags % nfft] / scale[:, None]
+    # lags at least as long as the series have no overlap
+    ccf[np.abs(lags)[None, :] >= n[:, None]] = np.nan
+    return lags, ccf, n
+
+
+def lagged_design(values, lags):
+    """(rows, days, lags) array whose [:, t, j] is values[:, t - lags[j]], NaN before the start."""
+    out = np.full(values.shape + (len(lags),), np.nan)
+    for j, k in enumerate(lags):
+        # a lag as long as the panel leaves the whole column NaN
+        if k < values.shape[1]:
+            out[:, k:, j] = values[:, :values.shape[1] - k]
+    return out
+
+
+def batched_rss(X, y, mask):
+    """Residual sum of squares of a least squares fit of y on X, separately for every row.
+
+    Masked out days are zeroed so they drop out of X'X and X'y, and all rows are solved in
+    one batched pseudo-inverse (which also copes with a constant regressor).
+    """
+    X = np.where(mask[..., None], X, 0.0)
+    y = np.where(mask, y, 0.0)
+    beta = np.linalg.pinv(X.transpose(0, 2, 1) @ X) @ (X.transpose(0, 2, 1) @ y[..., None])
+    resid = np.where(mask, y - (X @ beta)[..., 0], 0.0)
+    return (resid ** 2).sum(axis=1)
+
+
+def granger_tests(x, y, lag):
+    """Granger F test of "x helps predict y" with `lag` lags, for every row at once.
+
+    Compares y on its own lags plus a constant with the same model plus lags of x, like the
+    ssr F test in statsmodels' grangercausalitytests.
+    reference: https://www.statsmodels.org/stable/generated/statsmodels.tsa.stattools.grangercausalitytests.html
+    """
+    lags = np.arange(1, lag + 1)
+    y_lags, x_lags = lagged_design(y, lags), lagged_design(x, lags)
+    const = np.ones(y.shape + (1,))
+    mask = ~np.isnan(y) & ~np.isnan(y_lags).any(axis=2) & ~np.isnan(x_lags).any(axis=2)
+    nobs = mask.sum(axis=1)
+    rss_r = batched_rss(np.concatenate([y_lags, const], axis=2), y, mask)
+    rss_u = batched_rss(np.concatenate([y_lags, x_lags, const], axis=2), y, mask)
+    df = nobs - 2 * lag - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f = np.where(df > 0, (rss_r - rss_u) / lag / (rss_u / df), np.nan)
+    return nobs, f, stats.f.sf(f, lag, df)
+
+
+def lead_lag(data, drivers=DRIVERS, target=TARGET, max_lag=MAX_LAG, granger_lags=GRANGER_LAGS, chunk=TICKER_CHUNK):
+    """Cross-correlations over -max_lag..max_lag and Granger tests for every ticker and driver.
+
+    Returns two tidy tables: (ticker, driver, lag, n, ccf) and (ticker, driver, lag, nobs, F, p_value).
+    A positive ccf lag k pairs the driver on day t with the target on day t + k.
+    """
+    tickers, panel = to_panel(data, drivers + [target])
+    ccf_frames, granger_frames = [], []
+    for start in range(0, len(tickers), chunk):
+        rows = slice(start, start + chunk)
+        names = tickers[rows]
+        y = panel[target][rows]
+        for driver in drivers:
+            x = panel[driver][rows]
+            lags, ccf, n = cross_correlations(x, y, max_lag)
+            ccf_frames.append(pd.DataFrame({
+                'ticker': np.repeat(names, len(lags)), 'driver': driver, 'lag': np.tile(lags, len(names)),
+                'n': np.repeat(n, len(lags)), 'ccf': ccf.ravel(),
+            }))
+            for lag in granger_lags:
+                nobs, f, p = granger_tests(x, y, lag)
+                granger_frames.append(pd.DataFrame({'ticker': names, 'driver': driver, 'lag': lag,
+                                                    'nobs': nobs, 'F': f, 'p_value': p}))
+    ccf = pd.concat(ccf_frames, ignore_index=True).sort_values(['driver', 'ticker', 'lag'], kind='stable')
+    granger = pd.concat(granger_frames, ignore_index=True).sort_values(['driver', 'ticker', 'lag'], kind='stable')
+    return ccf.reset_index(drop=True), granger.reset_index(drop=True)
+
+
+def add_lag_features(data, cols=DRIVERS, lags=range(1, 4)):
+    """Add `<col>_lag<k>` columns (the value k trading days earlier for the same ticker).
+
+    Returns the data sorted by ticker and date with the new column names; the first k days of
+    every ticker have NaN lags.
+    """
+    data, group_pos = sort_by_ticker(data)
+    names = []
+    for col in cols:
+        values = data[col].to_numpy(dtype=float)
+        for k in lags:
+            lagged = np.full(len(values), np.nan)
+            if k < len(values):
+                lagged[k:] = values[:len(values) - k]
+            lagged[group_pos < k] = np.nan
+            data[f'{col}_lag{k}'] = lagged
+            names.append(f'{col}_lag{k}')
+    return data, names
+
+
+def main(tickers=None, max_lag=MAX_LAG):
+    os.makedirs('stats', exist_ok=True)
+
+    data = read_table('merge_cleaned/dataset', columns=['Date', TARGET] + DRIVERS, tickers=tickers)
+    with section('leadlag.lead_lag', rows=len(data)):
+        ccf, granger = lead_lag(data, max_lag=max_lag)
+    ccf.to_csv('stats/leadlag_ccf.csv', index=False)
+    granger.to_csv('stats/leadlag_granger.csv', index=False)
+
+    # print results
+    # strongest lead of each driver (positive lag = reddit first), and how often it granger-causes vol_5d
+    leads = ccf[ccf['lag'] > 0].dropna(subset=['ccf'])
+    best = leads.loc[leads['ccf'].abs().groupby([leads['driver'], leads['ticker']]).idxmax()]
+    for driver, group in best.groupby('driver'):
+        print(f'{driver} leading {TARGET}: most common strongest lead is {group["lag"].mode().iloc[0]} day(s), '
+              f'median |ccf| {group["ccf"].abs().median():.3f} over {len(group)} tickers')
+    summary = granger.assign(significant=granger['p_value'] < 0.05).groupby(['driver', 'lag'])['significant'].agg(['size', 'sum'])
+    summary.columns = ['tickers', 'granger p < 0.05']
+    print(summary.to_string())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    # defaults to every ticker in the dataset
+    parser.add_argument('--tickers', nargs='+')
+    parser.add_argument('--max-lag', type=int, default=MAX_LAG)
+    args = parser.parse_args()
+    with profile_stage('leadlag'):
+        main(tickers=args.tickers, max_lag=args.max_lag)
@@ -1,48 +1,327 @@
 import pandas as pd
 import numpy as np
+import argparse
+import json
 import os
+from profiling import profile_stage, section
+from storage import list_partitions, read_table, write_table
 
-def main():
-    os.makedirs('merge_cleaned', exist_ok=True)
-    
-    # load stock prices from yfinance and reddit data
-    gme_prices = pd.read_csv('scrape_stock/stock_data_GME.csv')
-    open_prices = pd.read_csv('scrape_stock/stock_data_OPEN.csv')
-    reddit = pd.read_csv('scrape_stock/reddit_daily.csv')
-
-    # combining stock prices into a single DataFrame
-    prices = pd.concat([gme_prices, open_prices])
-    # setting each column to the correct type
-    prices['Date'] = pd.to_datetime(prices['Date'])
-    prices['Close'] = pd.to_numeric(prices['Close'], errors='coerce')
-    prices['Volume'] = pd.to_numeric(prices['Volume'], errors='coerce')
-    # remove any duplicate rows
-    prices = prices.drop_duplicates(subset=['Date', 'ticker'])
-    # sort the prices by ticker and then date
-    prices = prices.sort_values(['ticker', 'Date'])
-    # calculate daily returns for volatility calculation
-    prices['ret'] = prices.groupby('ticker')['Close'].pct_change()
-    # calculate rolling volatility
-    prices['vol_5d'] = prices.groupby('ticker')['ret'].transform(lambda x: x.rolling(5).std())
-
-    # setting date column for reddit data
-    reddit['date'] = pd.to_datetime(reddit['date'])
+# realized volatility estimators, all computed for every ticker at once
+# close-to-close std of returns over each window (vol_5d is the one the models use)
+VOL_WINDOWS = [5, 10, 21]
+# window for the high/low range estimators
+RANGE_WINDOW = 5
+# RiskMetrics decay for the EWMA volatility
+EWMA_LAMBDA = 0.94
+FEATURE_COLS = [f'vol_{w}d' for w in VOL_WINDOWS] + [f'parkinson_{RANGE_WINDOW}d', f'garman_klass_{RANGE_WINDOW}d', 'ewma_vol']
+
+
+def cumulative(values):
+    """Running sums of `values` and of how many are non-missing, the input to rolling_sum."""
+    valid = ~np.isnan(values)
+    csum = np.concatenate([[0.0], np.cumsum(np.where(valid, values, 0.0))])
+    ccount = np.concatenate([[0], np.cumsum(valid)])
+    return csum, ccount
+
+
+def rolling_sum(cum, group_pos, window):
+    """Sum of the last `window` values of each ticker, for all tickers in one pass.
+
+    `cum` comes from cumulative() on values sorted by ticker then date, and `group_pos` is
+    each row's position inside its ticker. Differences of running sums replace a rolling
+    window per ticker, and like pandas' rolling() the result is NaN until there is a full
+    window without missing values.
+    """
+    csum, ccount = cum
+    out = np.full(len(csum) - 1, np.nan)
+    if len(out) >= window:
+        # row i gets the sum of rows i-window+1..i
+        full = ccount[window:] - ccount[:-window] == window
+        out[window - 1:] = np.where(full, csum[window:] - csum[:-window], np.nan)
+    # windows reaching back into the previous ticker
+    out[group_pos < window - 1] = np.nan
+    return out
+
+
+def sort_by_ticker(prices):
+    """Sort by ticker then date and return each row's position inside its ticker."""
+    # integer codes sort much faster than the ticker strings
+    codes, _ = pd.factorize(prices['ticker'], sort=True)
+    order = np.lexsort((prices['Date'].to_numpy(), codes))
+    prices = prices.iloc[order].reset_index(drop=True)
+    codes = codes[order]
+    idx = np.arange(len(codes))
+    starts = np.ones(len(codes), dtype=bool)
+    starts[1:] = codes[1:] != codes[:-1]
+    group_pos = idx - np.maximum.accumulate(np.where(starts, idx, 0))
+    return prices, group_pos
+
+
+def add_volatility_features(prices, windows=VOL_WINDOWS, range_window=RANGE_WINDOW, ewma_lambda=EWMA_LAMBDA):
+    """Add returns and every volatility estimator to a price table with Open/High/Low/Close columns."""
+    # reference: https://portfolioslab.com/tools/parkinson
+    # reference: https://portfolioslab.com/tools/garman-klass
+    # reference: https://www.msci.com/documents/10199/5915b101-4206-4ba0-aee2-3449d5c7e95a (RiskMetrics EWMA)
+    prices, group_pos = sort_by_ticker(prices)
+
+    # calculate daily returns for volatility calculation (first day of each ticker has none)
+    close = prices['Close'].to_numpy(dtype=float)
+    ret = np.full(len(close), np.nan)
+    ret[1:] = close[1:] / close[:-1] - 1
+    ret[group_pos == 0] = np.nan
+    prices['ret'] = ret
+
+    # close-to-close: sample std from rolling sums of r and r^2
+    cum1, cum2 = cumulative(ret), cumulative(ret ** 2)
+    for w in windows:
+        s1 = rolling_sum(cum1, group_pos, w)
+        s2 = rolling_sum(cum2, group_pos, w)
+        prices[f'vol_{w}d'] = np.sqrt(np.maximum(s2 - s1 ** 2 / w, 0) / (w - 1))
+
+    # parkinson and garman-klass use the day's range, so they don't need a previous close
+    hl = np.log(prices['High'].to_numpy(dtype=float) / prices['Low'].to_numpy(dtype=float)) ** 2
+    co = np.log(close / prices['Open'].to_numpy(dtype=float)) ** 2
+    parkinson = rolling_sum(cumulative(hl), group_pos, range_window) / range_window
+    prices[f'parkinson_{range_window}d'] = np.sqrt(parkinson / (4 * np.log(2)))
+    gk = rolling_sum(cumulative(0.5 * hl - (2 * np.log(2) - 1) * co), group_pos, range_window) / range_window
+    prices[f'garman_klass_{range_window}d'] = np.sqrt(np.maximum(gk, 0))
+
+    # ewma of squared returns, adjust=False is the usual recursive form sigma^2 = l * sigma^2 + (1 - l) * r^2
+    ewma_var = (prices['ret'] ** 2).groupby(prices['ticker'], sort=False).ewm(alpha=1 - ewma_lambda, adjust=False).mean()
+    prices['ewma_vol'] = np.sqrt(ewma_var.droplevel(0))
+    return prices
+
+
+class P2Quantile:
+    """Running estimate of one quantile in constant memory (the P-square algorithm).
+
+    Keeps 5 markers (min, p/2, p, (1+p)/2, max) and nudges them as values arrive,
+    so the high_vol threshold can be updated without the whole vol_5d history.
+    reference: https://www.cse.wustl.edu/~jain/papers/ftp/psqr.pdf
+    """
+
+    def __init__(self, p=0.75):
+        self.p = p
+        self.dn = [0, p / 2, p, (1 + p) / 2, 1]
+        # the first 5 values are kept as-is until the markers can be placed
+        self.initial = []
+        self.q = None
+        self.n = None
+        self.np = None
+
+    @classmethod
+    def from_values(cls, values, p=0.75):
+        """Start from a known history by placing the markers at its exact quantiles."""
+        sketch = cls(p)
+        values = np.sort(np.asarray(values, dtype=float))
+        if len(values) < 5:
+            sketch.initial = values.tolist()
+            return sketch
+        count = len(values)
+        sketch.q = np.quantile(values, sketch.dn).tolist()
+        sketch.np = [1 + (count - 1) * d for d in sketch.dn]
+        sketch.n = [1]
+        for desired in sketch.np[1:]:
+            sketch.n.append(max(int(round(desired)), sketch.n[-1] + 1))
+        sketch.n[4] = max(count, sketch.n[3] + 1)
+        return sketch
+
+    def add(self, x):
+        if self.q is None:
+            self.initial.append(x)
+            if len(self.initial) == 5:
+                self.q = sorted(self.initial)
+                self.n = [1, 2, 3, 4, 5]
+                self.np = [1, 1 + 2 * self.p, 1 + 4 * self.p, 3 + 2 * self.p, 5]
+            return
+
+        q, n = self.q, self.n
+        # find the cell x falls in, stretching the ends if it is a new min/max
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = next(i for i in range(4) if x < q[i + 1])
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.np[i] += self.dn[i]
+
+        # move the middle markers towards where they should be
+        for i in (1, 2, 3):
+            d = self.np[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                parabolic = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if q[i - 1] < parabolic < q[i + 1]:
+                    q[i] = parabolic
+                else:
+                    q[i] = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                n[i] += d
+
+    def value(self):
+        if self.q is None:
+            return float(np.quantile(self.initial, self.p)) if self.initial else np.nan
+        return self.q[2]
+
+    def to_dict(self):
+        return {'p': self.p, 'initial': self.initial, 'q': self.q, 'n': self.n, 'np': self.np}
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state['p'])
+        sketch.initial, sketch.q, sketch.n, sketch.np = state['initial'], state['q'], state['n'], state['np']
+        return sketch
+
+
+# per-ticker state kept between runs for the incremental mode
+STATE_PATH = 'merge_cleaned/feature_state.json'
+PRICE_COLS = ['Date', 'Open', 'High', 'Low', 'Close', 'Volume']
+# enough past bars for the longest window plus the return feeding into it
+TAIL_ROWS = max(max(VOL_WINDOWS) + 1, RANGE_WINDOW)
+
+
+def merge_reddit(prices, reddit):
     # merge reddit data with stock data
     dataset = pd.merge(prices, reddit, left_on=['Date', 'ticker'], right_on=['date', 'ticker'], how='left')
     # fill missing reddit data with zeros
     reddit_cols = ['avg_sentiment', 'mention_count']
     dataset[reddit_cols] = dataset[reddit_cols].fillna(0)
-    # create high volatility indicator (above 75th percentile)
-    dataset['high_vol'] = dataset.groupby('ticker')['vol_5d'].transform(lambda x: (x > x.quantile(0.75)).astype(int))
     # add features used in modeling
     dataset['mentioned_on_reddit'] = (dataset['mention_count'] > 0).astype(int)
+    return dataset
+
+
+def build_state(prices, dataset, state=None):
+    """Per-ticker rolling state: last few bars, last EWMA variance and the high_vol quantile sketch."""
+    state = state or {}
+    tails = prices.groupby('ticker', sort=False).tail(TAIL_ROWS)
+    ewma_var = prices.groupby('ticker', sort=False)['ewma_vol'].last() ** 2
+    for ticker, tail in tails.groupby('ticker', sort=False):
+        entry = state.setdefault(ticker, {})
+        entry['last_date'] = tail['Date'].max().strftime('%Y-%m-%d')
+        entry['tail'] = {c: tail[c].tolist() for c in PRICE_COLS if c != 'Date'}
+        entry['tail']['Date'] = tail['Date'].dt.strftime('%Y-%m-%d').tolist()
+        entry['ewma_var'] = None if pd.isna(ewma_var[ticker]) else float(ewma_var[ticker])
+    # a full rebuild starts each sketch from that ticker's whole vol_5d history
+    for ticker, vols in dataset.groupby('ticker', sort=False)['vol_5d']:
+        if 'sketch' not in state[ticker]:
+            state[ticker]['sketch'] = P2Quantile.from_values(vols.dropna()).to_dict()
+    return state
+
+
+def save_state(state):
+    with open(STATE_PATH + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(STATE_PATH + '.tmp', STATE_PATH)
+
+
+def update(csv=False):
+    """Append only the trading days that arrived since the last run to merge_cleaned/dataset.
+
+    Uses the saved per-ticker state instead of the full history, so the cost grows with
+    the number of new rows. Rows already written keep their high_vol label; new rows are
+    labelled against the running 75th percentile including themselves.
+    """
+    if not os.path.exists(STATE_PATH):
+        print('no saved feature state yet, running a full rebuild')
+        return main(csv=csv)
+    with open(STATE_PATH) as f:
+        state = json.load(f)
+
+    # known tickers only need bars after their last processed day, new tickers need everything
+    new_tickers = [t for t in list_partitions('scrape_stock/prices') if t not in state]
+    oldest = min((entry['last_date'] for entry in state.values()), default=None)
+    new_prices = read_table('scrape_stock/prices', columns=PRICE_COLS, tickers=list(state), start=oldest)
+    if new_tickers:
+        new_prices = pd.concat([new_prices, read_table('scrape_stock/prices', columns=PRICE_COLS, tickers=new_tickers)])
+    last_dates = pd.to_datetime(new_prices['ticker'].map({t: e['last_date'] for t, e in state.items()}))
+    new_prices = new_prices[last_dates.isna() | (new_prices['Date'] > last_dates)].drop_duplicates(subset=['Date', 'ticker'])
+    if new_prices.empty:
+        print('no new trading days')
+        return
+    new_prices['is_new'] = True
+
+    # put the saved tail in front of the new bars so the rolling windows have their history
+    tails = [pd.DataFrame({**state[t]['tail'], 'ticker': t}) for t in new_prices['ticker'].unique() if t in state]
+    if tails:
+        tails = pd.concat(tails)
+        tails['Date'] = pd.to_datetime(tails['Date'])
+        tails['is_new'] = False
+        new_prices = pd.concat([tails, new_prices])
+    with section('merge_clean.features', rows=len(new_prices)):
+        prices = add_volatility_features(new_prices)
+
+    # the ewma carries on from the saved variance rather than restarting at the tail
+    ewma_vol = prices['ewma_vol'].to_numpy(copy=True)
+    alpha = 1 - EWMA_LAMBDA
+    for ticker, idx in prices[prices['is_new']].groupby('ticker', sort=False).indices.items():
+        var = state.get(ticker, {}).get('ewma_var')
+        if var is None:
+            continue
+        for i in prices.index[prices['is_new']][idx]:
+            ret = prices.at[i, 'ret']
+            if not np.isnan(ret):
+                var = EWMA_LAMBDA * var + alpha * ret ** 2
+            ewma_vol[i] = np.sqrt(var)
+    prices['ewma_vol'] = ewma_vol
+
+    reddit = read_table('scrape_stock/reddit_daily', tickers=list(prices['ticker'].unique()),
+                        start=prices.loc[prices['is_new'], 'Date'].min())
+    dataset = merge_reddit(prices[prices['is_new']], reddit).dropna(subset=['vol_5d'])
+
+    # update each ticker's running 75th percentile with its new days, then label them
+    thresholds = {}
+    for ticker, vols in dataset.groupby('ticker', sort=False)['vol_5d']:
+        sketch = P2Quantile.from_dict(state[ticker]['sketch']) if 'sketch' in state.get(ticker, {}) else P2Quantile()
+        for v in vols:
+            sketch.add(v)
+        state.setdefault(ticker, {})['sketch'] = sketch.to_dict()
+        thresholds[ticker] = sketch.value()
+    dataset['high_vol'] = (dataset['vol_5d'] > dataset['ticker'].map(thresholds)).astype(int)
+
+    final_cols = ['Date', 'ticker', 'Close', 'Volume'] + FEATURE_COLS + ['high_vol', 'mentioned_on_reddit', 'mention_count', 'avg_sentiment']
+    if not dataset.empty:
+        write_table(dataset[final_cols], 'merge_cleaned/dataset', mode='append', csv=csv)
+    save_state(build_state(prices, dataset, state))
+    print(f'appended {len(dataset)} new rows for {dataset["ticker"].nunique()} tickers')
+
+
+def main(csv=False):
+    os.makedirs('merge_cleaned', exist_ok=True)
+    
+    # load stock prices from yfinance and reddit data
+    # stored tables are already typed, so only the columns used here are loaded
+    with section('merge_clean.load') as s:
+        prices = read_table('scrape_stock/prices', columns=PRICE_COLS)
+        reddit = read_table('scrape_stock/reddit_daily')
+        s.rows = len(prices) + len(reddit)
+
+    # remove any duplicate rows
+    prices = prices.drop_duplicates(subset=['Date', 'ticker'])
+    # calculate daily returns and rolling volatility (sorts by ticker and then date)
+    with section('merge_clean.features', rows=len(prices)):
+        prices = add_volatility_features(prices)
+
+    with section('merge_clean.merge', rows=len(prices)):
+        dataset = merge_reddit(prices, reddit)
+    # create high volatility indicator (above 75th percentile)
+    dataset['high_vol'] = (dataset['vol_5d'] > dataset.groupby('ticker')['vol_5d'].transform('quantile', 0.75)).astype(int)
     # select final columns (only what's actually used)
-    final_cols = ['Date', 'ticker', 'Close', 'Volume', 'vol_5d', 'high_vol', 'mentioned_on_reddit', 'mention_count', 'avg_sentiment']
+    final_cols = ['Date', 'ticker', 'Close', 'Volume'] + FEATURE_COLS + ['high_vol', 'mentioned_on_reddit', 'mention_count', 'avg_sentiment']
     dataset = dataset[final_cols].dropna(subset=['vol_5d'])
-    dataset.to_csv('merge_cleaned/dataset.csv', index=False)
+    with section('merge_clean.write', rows=len(dataset)):
+        write_table(dataset, 'merge_cleaned/dataset', csv=csv)
+    # saved so later runs can use --incremental
+    save_state(build_state(prices, dataset))
     
-    # show correlation preview for both tickers
-    for ticker in ['GME', 'OPEN']:
+    # show correlation preview for every ticker
+    for ticker in dataset['ticker'].unique():
         ticker_data = dataset[dataset['ticker'] == ticker]
         if len(ticker_data) > 0:
             # show basic stats first
@@ -67,4 +346,14 @@ def main():
                 print(f'mentioned_on_reddit vs high_vol correlation: N/A (no variance)')
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    # also export merge_cleaned/dataset.csv next to the parquet folder
+    parser.add_argument('--csv', action='store_true')
+    # only add the days that arrived since the last run instead of rebuilding everything
+    parser.add_argument('--incremental', action='store_true')
+    args = parser.parse_args()
+    with profile_stage('merge_clean'):
+        if args.incremental:
+            update(csv=args.csv)
+        else:
+            main(csv=args.csv)
\ No newline at end of file
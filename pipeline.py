@@ -0,0 +1,261 @@
+import argparse
+import hashlib
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# the workflow from the README as a DAG. each stage is its own script run as a subprocess, with:
+#   deps:    stages that have to finish first
+#   inputs:  files/folders it reads (fingerprinted by size and mtime, so big datasets are cheap to check)
+#   code:    modules it runs (fingerprinted by content, so editing a stage reruns it)
+#   outputs: what it writes, a stage with missing outputs always runs
+#   args:    default command line, part of the fingerprint too
+#   network: the stage reads from the network (and config files it names), which can't be fingerprinted,
+#            so it always runs when selected: True, or a list of flags that make it do so (e.g. --fetch)
+STAGES = {
+    'scrape': {
+        'deps': [],
+        'inputs': [],
+        'code': ['scrape.py', 'prices.py', 'sentiment.py', 'store.py', 'storage.py'],
+        'outputs': ['scrape_stock/prices', 'scrape_stock/reddit_daily'],
+        'args': [],
+        'network': True,
+    },
+    'merge_clean': {
+        'deps': ['scrape'],
+        'inputs': ['scrape_stock/prices', 'scrape_stock/reddit_daily'],
+        'code': ['merge_clean.py', 'storage.py'],
+        'outputs': ['merge_cleaned/dataset'],
+        'args': [],
+    },
+    'statistical_tests': {
+        'deps': ['merge_clean'],
+        'inputs': ['merge_cleaned/dataset'],
+        'code': ['statistical_tests.py', 'storage.py'],
+        'outputs': ['stats/stats_results.csv'],
+        'args': [],
+    },
+    'resampling': {
+        'deps': ['merge_clean'],
+        'inputs': ['merge_cleaned/dataset'],
+        'code': ['resampling.py', 'storage.py'],
+        'outputs': ['stats/resampling_results.csv'],
+        'args': [],
+    },
+    'leadlag': {
+        'deps': ['merge_clean'],
+        'inputs': ['merge_cleaned/dataset'],
+        'code': ['leadlag.py', 'merge_clean.py', 'storage.py'],
+        'outputs': ['stats/leadlag_ccf.csv', 'stats/leadlag_granger.csv'],
+        'args': [],
+    },
+    'train': {
+        'deps': ['merge_clean'],
+        'inputs': ['merge_cleaned/dataset'],
+        'code': ['train.py', 'leadlag.py', 'merge_clean.py', 'storage.py'],
+        'outputs': ['stats/predictions.csv', 'models'],
+        'args': [],
+    },
+    'visuals': {
+        'deps': ['merge_clean'],
+        'inputs': ['merge_cleaned/dataset'],
+        'code': ['visuals.py', 'storage.py'],
+        'outputs': ['visuals/timeseries.png', 'visuals/boxplot.png', 'visuals/scatterplot.png', 'visuals/barchart.png'],
+        'args': ['--headless'],
+    },
+    'intraday': {
+        'deps': ['scrape'],
+        'inputs': ['scrape_stock/minute_bars', 'scrape_stock/reddit_raw'],
+        'code': ['intraday.py', 'merge_clean.py', 'prices.py', 'storage.py'],
+        'outputs': ['merge_cleaned/intraday'],
+        'args': [],
+        'network': ['--fetch'],
+    },
+}
+# the scrape needs reddit credentials and the network, and intraday needs minute bars
+# (intraday.py --fetch), so they only run when asked for
+OPT_IN = {'scrape', 'intraday'}
+
+# stage scripts live next to this file, data paths are relative to where it's run (like the scripts)
+HERE = os.path.dirname(os.path.abspath(__file__))
+# fingerprint of every stage's last successful run
+STATE_PATH = 'pipeline_state.json'
+LOG_DIR = 'logs'
+
+
+def _files(path):
+    if os.path.isfile(path):
+        yield path
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            yield os.path.join(root, name)
+
+
+def fingerprint(stage, args):
+    """Hash of everything that decides a stage's output: inputs, code and arguments."""
+    spec = STAGES[stage]
+    h = hashlib.sha256()
+    h.update(json.dumps(args).encode())
+    for path in spec['inputs']:
+        for f in _files(path):
+            st = os.stat(f)
+            h.update(f'{f}:{st.st_size}:{st.st_mtime_ns}\n'.encode())
+    for path in spec['code']:
+        h.update(path.encode())
+        with open(os.path.join(HERE, path), 'rb') as f:
+            h.update(hashlib.sha256(f.read()).digest())
+    return h.hexdigest()
+
+
+def load_state():
+    if not os.path.exists(STATE_PATH):
+        return {}
+    with open(STATE_PATH) as f:
+        return json.load(f)
+
+
+def save_state(state):
+    with open(STATE_PATH + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(STATE_PATH + '.tmp', STATE_PATH)
+
+
+def reads_network(stage, args):
+    """True when this run of the stage fetches new data, so it is never up to date."""
+    network = STAGES[stage].get('network', False)
+    return network is True or any(flag in args for flag in network or [])
+
+
+def is_current(stage, args, state):
+    """True when the last successful run saw the same fingerprint and its outputs are still there."""
+    if reads_network(stage, args):
+        return False
+    if not all(os.path.exists(p) for p in STAGES[stage]['outputs']):
+        return False
+    return state.get(stage, {}).get('fingerprint') == fingerprint(stage, args)
+
+
+def run_stage(stage, args, profile_dir=None):
+    """Run one stage script, with its output going to logs/<stage>.log. Returns (exit code, seconds)."""
+    os.makedirs(LOG_DIR, exist_ok=True)
+    # the stage writes its timings to profile_dir/<stage>.json (see profiling.py)
+    env = dict(os.environ, PROFILE_DIR=os.path.abspath(profile_dir)) if profile_dir else None
+    start = time.perf_counter()
+    with open(os.path.join(LOG_DIR, f'{stage}.log'), 'w') as log:
+        code = subprocess.call([sys.executable, os.path.join(HERE, f'{stage}.py')] + args, stdout=log,
+                               stderr=subprocess.STDOUT, env=env)
+    return code, time.perf_counter() - start
+
+
+def selected_stages(targets, with_scrape):
+    """The requested stages plus everything upstream of them (OPT_IN stages only if asked for)."""
+    wanted = set()
+    todo = list(targets or [s for s in STAGES if s not in OPT_IN])
+    while todo:
+        stage = todo.pop()
+        if stage in wanted:
+            continue
+        wanted.add(stage)
+        todo.extend(STAGES[stage]['deps'])
+    skip = OPT_IN - set(targets or [])
+    if with_scrape:
+        skip.discard('scrape')
+    wanted -= skip
+    return [s for s in STAGES if s in wanted]
+
+
+def run(targets=None, with_scrape=False, force=(), stage_args=None, workers=None, dry_run=False, profile_dir=None):
+    """Run the selected stages in dependency order, skipping up to date ones.
+
+    A stage starts as soon as all its selected deps are done, so the stages after merge_clean
+    run at the same time. A stage's fingerprint is taken when it is ready to start, so it sees
+    the outputs its deps just wrote. If a stage fails, the stages after it don't run.
+    """
+    stages = selected_stages(targets, with_scrape or 'scrape' in (targets or []))
+    args = {s: list(STAGES[s]['args']) + list((stage_args or {}).get(s, [])) for s in stages}
+    state = load_state()
+    deps = {s: [d for d in STAGES[s]['deps'] if d in stages] for s in stages}
+    done, failed, ran, status = set(), set(), set(), {}
+    pending = list(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers or len(stages) or 1) as pool:
+        while pending or running:
+            for stage in list(pending):
+                if any(d in failed for d in deps[stage]):
+                    pending.remove(stage)
+                    failed.add(stage)
+                    status[stage] = 'skipped (upstream failed)'
+                elif all(d in done for d in deps[stage]):
+                    pending.remove(stage)
+                    # a dep that reran rewrote this stage's inputs, which changes its fingerprint
+                    # (a dry run can't see that, so it assumes it)
+                    stale = stage in force or (dry_run and any(d in ran for d in deps[stage]))
+                    if not stale and is_current(stage, args[stage], state):
+                        done.add(stage)
+                        status[stage] = 'up to date'
+                    elif dry_run:
+                        done.add(stage)
+                        ran.add(stage)
+                        status[stage] = 'would run'
+                    else:
+                        print(f'{stage}: running {shlex.join([stage + ".py"] + args[stage])}')
+                        # forget the old run first, so a failed or killed run is never seen as up to date
+                        state.pop(stage, None)
+                        save_state(state)
+                        running[pool.submit(run_stage, stage, args[stage], profile_dir)] = stage
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                code, seconds = future.result()
+                if code == 0:
+                    done.add(stage)
+                    # fingerprint again now, with the code and inputs the run actually used
+                    state[stage] = {'fingerprint': fingerprint(stage, args[stage]), 'seconds': round(seconds, 2),
+                                    'finished_at': time.strftime('%Y-%m-%dT%H:%M:%S')}
+                    save_state(state)
+                    status[stage] = f'ran in {seconds:.1f}s'
+                else:
+                    failed.add(stage)
+                    status[stage] = f'failed with exit code {code}, see {LOG_DIR}/{stage}.log'
+                print(f'{stage}: {status[stage]}')
+
+    for stage in stages:
+        print(f'{stage:>18}: {status[stage]}')
+    return not failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    # stages to bring up to date (with everything they depend on), default: all but scrape
+    parser.add_argument('stages', nargs='*')
+    # also run the reddit/price scrape at the start (needs credentials, see README)
+    parser.add_argument('--scrape', action='store_true')
+    # rerun these stages even if they are up to date
+    parser.add_argument('--force', nargs='+', default=[], choices=list(STAGES))
+    # extra arguments for a stage script, e.g. --set "merge_clean=--incremental" --set "train=--lags 3"
+    parser.add_argument('--set', action='append', default=[], metavar='STAGE=ARGS')
+    # how many stages may run at the same time (defaults to all that are ready)
+    parser.add_argument('--workers', type=int)
+    # only show what would run
+    parser.add_argument('--dry-run', action='store_true')
+    # write per-stage timings as json to this folder (see profiling.py)
+    parser.add_argument('--profile', metavar='DIR')
+    args = parser.parse_args()
+    for stage in args.stages:
+        if stage not in STAGES:
+            parser.error(f'unknown stage: {stage} (choose from {", ".join(STAGES)})')
+    stage_args = {}
+    for item in args.set:
+        stage, _, extra = item.partition('=')
+        if stage not in STAGES:
+            parser.error(f'unknown stage in --set: {stage}')
+        stage_args.setdefault(stage, []).extend(shlex.split(extra))
+    ok = run(args.stages, with_scrape=args.scrape, force=set(args.force), stage_args=stage_args,
+             workers=args.workers, dry_run=args.dry_run, profile_dir=args.profile)
+    sys.exit(0 if ok else 1)
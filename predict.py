@@ -0,0 +1,120 @@
+import pandas as pd
+import numpy as np
+import argparse
+import joblib
+import json
+import os
+import sys
+import time
+from train import MODEL_DIR
+
+
+class Predictor:
+    """Loads a saved model once and keeps it warm for scoring batches of new (ticker, date) rows.
+
+    Use predict() for DataFrames with the model's feature columns and predict_array() on the
+    hot path when the features are already a numpy array in that order.
+    """
+
+    def __init__(self, name='random_forest', version='latest'):
+        if version == 'latest':
+            with open(os.path.join(MODEL_DIR, name, 'LATEST')) as f:
+                version = f.read().strip()
+        path = os.path.join(MODEL_DIR, name, version)
+        self.model = joblib.load(os.path.join(path, 'model.joblib'))
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.feature_cols = self.meta['feature_cols']
+        # random forests default to one core already, this keeps a saved n_jobs=-1 from
+        # starting a thread pool for every small batch
+        if hasattr(self.model, 'n_jobs'):
+            self.model.n_jobs = 1
+        # first call pays for lazy imports and allocations, do it now instead of on a real request
+        self.predict_array(np.zeros((1, len(self.feature_cols))))
+
+    def predict_array(self, X):
+        """Probability of a high volatility day for each row of X."""
+        return self.model.predict_proba(X)[:, 1]
+
+    def predict(self, rows):
+        """Score a DataFrame of rows, keeping any Date/ticker columns as identifiers."""
+        X = rows[self.feature_cols].to_numpy(dtype=float)
+        prob = self.predict_array(X)
+        out = rows[[c for c in ('Date', 'ticker') if c in rows.columns]].copy()
+        out['high_vol_prob'] = prob
+        out['predicted'] = (prob >= 0.5).astype(int)
+        return out
+
+
+def synthetic_rows(n, feature_cols, seed=0):
+    """Random rows for the model's feature columns (e.g. with train.py --lags lag columns too) for load testing."""
+    rng = np.random.default_rng(seed)
+    # sentiment columns are VADER scores in [-1, 1], the rest are mention counts
+    return np.column_stack([rng.uniform(-1, 1, n) if 'sentiment' in col else rng.poisson(5, n)
+                            for col in feature_cols]).astype(float)
+
+
+def benchmark(predictor, batch_size=100, batches=1000):
+    """Score `batches` synthetic batches one after another and report throughput and latency."""
+    X = synthetic_rows(batch_size * batches, predictor.feature_cols)
+    latencies = np.empty(batches)
+    start = time.perf_counter()
+    for i in range(batches):
+        t = time.perf_counter()
+        predictor.predict_array(X[i * batch_size:(i + 1) * batch_size])
+        latencies[i] = time.perf_counter() - t
+    total = time.perf_counter() - start
+    p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+    print(f"{predictor.meta['name']} {predictor.meta['version']}: {batches} batches of {batch_size} rows")
+    print(f'throughput: {batch_size * batches / total:,.0f} rows/sec')
+    print(f'batch latency: p50 {p50:.2f}ms, p99 {p99:.2f}ms')
+    print(f'per row: p50 {p50 * 1000 / batch_size:.1f}us, p99 {p99 * 1000 / batch_size:.1f}us')
+
+
+def serve(predictor, lines=sys.stdin, out=sys.stdout):
+    """Read JSON batches (a list of row objects per line) and write one JSON list of scores per line.
+
+    A line that can't be scored (bad JSON, missing feature columns, ...) gets an
+    {"error": ...} object instead, and the server keeps running.
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            rows = pd.DataFrame(json.loads(line))
+            scored = predictor.predict(rows)
+            if 'Date' in scored.columns:
+                scored['Date'] = scored['Date'].astype(str)
+            result = scored.to_json(orient='records')
+        except Exception as e:
+            result = json.dumps({'error': f'{type(e).__name__}: {e}'})
+        out.write(result + '\n')
+        out.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='random_forest')
+    parser.add_argument('--version', default='latest')
+    # score a parquet/csv file of new rows
+    parser.add_argument('--input')
+    parser.add_argument('--output', default='stats/new_predictions.csv')
+    # keep the model loaded and score JSON batches from stdin, one per line
+    parser.add_argument('--serve', action='store_true')
+    # synthetic load test
+    parser.add_argument('--bench', action='store_true')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--batches', type=int, default=1000)
+    args = parser.parse_args()
+
+    predictor = Predictor(args.model, args.version)
+    if args.bench:
+        benchmark(predictor, batch_size=args.batch_size, batches=args.batches)
+    elif args.serve:
+        serve(predictor)
+    elif args.input:
+        rows = pd.read_parquet(args.input) if not args.input.endswith('.csv') else pd.read_csv(args.input)
+        predictor.predict(rows).to_csv(args.output, index=False)
+        print(f'scored {len(rows)} rows -> {args.output}')
+    else:
+        parser.error('one of --input, --serve or --bench is required')
@@ -0,0 +1,138 @@
+import sqlite3
+import pandas as pd
+import yfinance as yf
+
+# local cache of daily OHLCV bars keyed by (ticker, date), plus which date ranges were
+# already asked for (weekends and holidays have no bars, so the bars alone can't tell)
+# reference: https://docs.python.org/3/library/sqlite3.html
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS bars (
+    ticker TEXT NOT NULL,
+    date TEXT NOT NULL,
+    open REAL,
+    high REAL,
+    low REAL,
+    close REAL,
+    volume REAL,
+    PRIMARY KEY (ticker, date)
+);
+CREATE TABLE IF NOT EXISTS coverage (
+    ticker TEXT NOT NULL,
+    start TEXT NOT NULL,
+    end TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS coverage_ticker ON coverage (ticker);
+'''
+
+BAR_COLS = ['Date', 'ticker', 'Open', 'High', 'Low', 'Close', 'Volume']
+
+
+class YFinanceProvider:
+    """Downloads bars for many tickers in one yfinance request."""
+
+    def __init__(self, interval='1d'):
+        # '1m' gives minute bars (yfinance only keeps the last 30 days of those, see intraday.py)
+        self.interval = interval
+
+    def download(self, tickers, start, end):
+        # reference: https://ranaroussi.github.io/yfinance/reference/api/yfinance.download.html
+        data = yf.download(list(tickers), start=start, end=end, interval=self.interval, auto_adjust=True,
+                           group_by='ticker', threads=True, progress=False)
+        if data.empty:
+            return pd.DataFrame(columns=BAR_COLS)
+        # (Ticker, Price) columns -> one row per ticker and day
+        bars = data.stack(level=0, future_stack=True).rename_axis(['Date', 'ticker']).rename_axis(columns=None).reset_index()
+        return bars.dropna(subset=['Close'])[BAR_COLS]
+
+
+class FixtureProvider:
+    """Serves bars from a local table (DataFrame, parquet or csv file) for offline runs and tests."""
+
+    def __init__(self, bars):
+        if isinstance(bars, str):
+            bars = pd.read_parquet(bars) if bars.endswith('.parquet') else pd.read_csv(bars, parse_dates=['Date'])
+        self.bars = bars
+        # how many batch requests were made, to check that cached ranges aren't fetched again
+        self.requests = 0
+
+    def download(self, tickers, start, end):
+        self.requests += 1
+        b = self.bars
+        # intraday bars can carry the exchange timezone, the window is then in that timezone too
+        tz = b['Date'].dt.tz
+        mask = b['ticker'].isin(list(tickers)) & (b['Date'] >= pd.Timestamp(start, tz=tz)) & (b['Date'] < pd.Timestamp(end, tz=tz))
+        return b.loc[mask, BAR_COLS]
+
+
+def subtract_ranges(start, end, covered):
+    """Parts of [start, end) not inside any of the `covered` [start, end) ranges (ISO date strings)."""
+    missing = []
+    cursor = start
+    for s, e in sorted(covered):
+        if e <= cursor:
+            continue
+        if s >= end:
+            break
+        if s > cursor:
+            missing.append((cursor, s))
+        cursor = max(cursor, e)
+    if cursor < end:
+        missing.append((cursor, end))
+    return missing
+
+
+class PriceStore:
+    """Cached daily bars that only downloads the date ranges it doesn't have yet."""
+
+    def __init__(self, path='scrape_stock/prices.db', provider=None):
+        self.provider = provider or YFinanceProvider()
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+
+    def missing(self, ticker, start, end):
+        covered = self.conn.execute('SELECT start, end FROM coverage WHERE ticker = ?', (ticker,)).fetchall()
+        return subtract_ranges(start, end, covered)
+
+    def fetch(self, windows):
+        """Download whatever is missing for `windows` ({ticker: (start, end)}, end exclusive like yfinance).
+
+        Tickers missing the same date range are grouped into one batch request.
+        """
+        batches = {}
+        for ticker, (start, end) in windows.items():
+            for gap in self.missing(ticker, start, end):
+                batches.setdefault(gap, []).append(ticker)
+
+        # today's bar isn't final until the close, so a range is only ever covered up to yesterday
+        today = pd.Timestamp.now().strftime('%Y-%m-%d')
+        for (start, end), tickers in batches.items():
+            print(f'downloading {len(tickers)} tickers for {start} to {end}')
+            bars = self.provider.download(tickers, start, end)
+            # yfinance doesn't raise for a failed or delisted ticker, it just has no bars, so
+            # only the tickers that came back count as covered (the others are retried next run)
+            returned = set(bars['ticker'])
+            covered_end = min(end, today)
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO bars VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    zip(bars['ticker'], pd.to_datetime(bars['Date']).dt.strftime('%Y-%m-%d'),
+                        bars['Open'], bars['High'], bars['Low'], bars['Close'], bars['Volume']))
+                if covered_end > start:
+                    self.conn.executemany('INSERT INTO coverage VALUES (?, ?, ?)',
+                                          [(t, start, covered_end) for t in tickers if t in returned])
+            missing = [t for t in tickers if t not in returned]
+            if missing:
+                print(f'no bars for {", ".join(missing)} ({start} to {end}), will retry next run')
+        return len(batches)
+
+    def load(self, windows):
+        """Bars for every {ticker: (start, end)} window, downloading only the gaps first."""
+        self.fetch(windows)
+        frames = [pd.read_sql_query(
+            'SELECT date AS Date, ticker, open AS Open, high AS High, low AS Low, close AS Close, volume AS Volume '
+            'FROM bars WHERE ticker = ? AND date >= ? AND date < ? ORDER BY date',
+            self.conn, params=(ticker, start, end), parse_dates=['Date']) for ticker, (start, end) in windows.items()]
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=BAR_COLS)
+
+    def close(self):
+        self.conn.close()
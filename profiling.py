@@ -0,0 +1,137 @@
+import atexit
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import ContextDecorator
+
+# per-stage instrumentation: wall/cpu time, peak memory, rows and bytes read/written for each
+# stage and hot section. recording is always on (it costs a few syscalls per section) and the
+# records are written as json when PROFILE_DIR is set, e.g. PROFILE_DIR=stats/profile python train.py
+# reference: https://docs.python.org/3/library/resource.html
+# reference: https://man7.org/linux/man-pages/man5/proc.5.html (/proc/self/io)
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+
+_records = []
+_local = threading.local()
+
+
+def _io_bytes():
+    # rchar/wchar count every read()/write(), including ones served from the page cache
+    # (linux only, None elsewhere)
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _peak_rss_mb():
+    # the whole process's high-water mark so far, not the section's own: resetting it (like
+    # train.py does with clear_refs) would also reset it for enclosing sections and other threads
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class section(ContextDecorator):
+    """Time a stage or hot section, as a `with` block or a decorator.
+
+    Records wall and cpu time, the cpu time of worker processes that finished inside it, the
+    process's peak RSS so far, bytes read/written and, if set on the yielded record, a row count:
+
+        with section('merge_clean.features') as s:
+            prices = add_volatility_features(prices)
+            s.rows = len(prices)
+
+    Sections can nest; each record keeps the name of the one it ran inside.
+    """
+
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        stack = _local.__dict__.setdefault('stack', [])
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self._read, self._written = _io_bytes()
+        self._children = _children_cpu()
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        read, written = _io_bytes()
+        _local.stack.pop()
+        _records.append({
+            'name': self.name,
+            'parent': self.parent,
+            'wall_s': round(wall, 6),
+            'cpu_s': round(cpu, 6),
+            'children_cpu_s': round(_children_cpu() - self._children, 6),
+            'process_peak_rss_mb': round(_peak_rss_mb(), 1),
+            'rows': None if self.rows is None else int(self.rows),
+            'read_bytes': None if read is None else read - self._read,
+            'write_bytes': None if written is None else written - self._written,
+            'failed': exc[0] is not None,
+        })
+        return False
+
+
+def records():
+    """Every section finished so far in this process, oldest first."""
+    return list(_records)
+
+
+def reset():
+    _records.clear()
+
+
+def summary(sections=None):
+    """Totals per section name, for sections that run many times (like one per scoring batch)."""
+    totals = {}
+    for rec in _records if sections is None else sections:
+        t = totals.setdefault(rec['name'], {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'rows': None,
+                                            'process_peak_rss_mb': 0.0})
+        t['calls'] += 1
+        t['wall_s'] = round(t['wall_s'] + rec['wall_s'], 6)
+        t['cpu_s'] = round(t['cpu_s'] + rec['cpu_s'], 6)
+        t['process_peak_rss_mb'] = max(t['process_peak_rss_mb'], rec['process_peak_rss_mb'])
+        if rec['rows'] is not None:
+            t['rows'] = (t['rows'] or 0) + rec['rows']
+    return totals
+
+
+def write_profile(stage, path=None):
+    """Write this process's sections as json to `path` (default PROFILE_DIR/<stage>.json)."""
+    path = path or os.path.join(PROFILE_DIR, f'{stage}.json')
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    report = {
+        'stage': stage,
+        'pid': os.getpid(),
+        'argv': sys.argv,
+        'finished_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'summary': summary(),
+        'sections': records(),
+    }
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    return path
+
+
+def profile_stage(stage):
+    """Section covering a whole stage script, with its json written at exit when PROFILE_DIR is set."""
+    if PROFILE_DIR:
+        atexit.register(write_profile, stage)
+    return section(stage)
@@ -0,0 +1,190 @@
+import pandas as pd
+import numpy as np
+from scipy import stats
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import multiprocessing
+import os
+from profiling import profile_stage, section
+from storage import read_table
+
+# reddit activity measures whose relationship with volatility gets resampled
+PAIRS = [('mention_count', 'vol_5d'), ('avg_sentiment', 'vol_5d')]
+METHODS = ['pearson', 'spearman']
+RESULT_COLS = ['ticker', 'x', 'y', 'method', 'n', 'block', 'r', 'ci_low', 'ci_high', 'p_asymptotic', 'p_perm']
+
+# block bootstrap and block permutation, both on a circle so every day is equally likely to be drawn
+# reference: https://www.stat.cmu.edu/~cshalizi/402/lectures/08-bootstrap/lecture-08.pdf (moving block bootstrap)
+# reference: https://arch.readthedocs.io/en/latest/bootstrap/timeseries-bootstraps.html
+
+
+def default_block(n):
+    """Block length from the usual n^(1/3) rule, so each block keeps a few days of autocorrelation."""
+    return max(1, int(round(n ** (1 / 3))))
+
+
+def row_corr(x, y):
+    """Pearson correlation of every row of x with the same row of y."""
+    xc = x - x.mean(axis=1, keepdims=True)
+    yc = y - y.mean(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (xc * yc).sum(axis=1) / np.sqrt((xc ** 2).sum(axis=1) * (yc ** 2).sum(axis=1))
+
+
+def resample_ranks(codes, n_values, idx):
+    """Average ranks (ties share a rank, like rankdata) inside every resample, without sorting.
+
+    `codes` are the dense ranks of the original values, so a resample's ranks follow from how
+    many times it drew each distinct value.
+    """
+    size = len(idx)
+    drawn = codes[idx] + np.arange(size)[:, None] * n_values
+    counts = np.bincount(drawn.ravel(), minlength=size * n_values).reshape(size, n_values)
+    avg_rank = np.cumsum(counts, axis=1) - (counts - 1) / 2
+    return np.take_along_axis(avg_rank, codes[idx], axis=1)
+
+
+def bootstrap_indices(n, block, size, rng):
+    """`size` circular block bootstrap samples of positions 0..n-1, one per row."""
+    n_blocks = -(-n // block)
+    starts = rng.integers(0, n, (size, n_blocks))
+    idx = (starts[:, :, None] + np.arange(block)) % n
+    return idx.reshape(size, -1)[:, :n]
+
+
+def permutation_indices(n, block, size, rng):
+    """`size` block permutations of positions 0..n-1, one per row.
+
+    The series is rotated by a random offset, cut into blocks of `block` days (the last one may
+    be shorter) and the blocks are shuffled, so days inside a block stay together.
+    """
+    n_blocks = -(-n // block)
+    pos = np.arange(n)
+    # new slot of every block, then sort positions by (slot, place inside the block)
+    slot = np.argsort(rng.random((size, n_blocks)), axis=1)
+    key = slot[:, pos // block] * block + pos % block
+    offset = rng.integers(0, n, (size, 1))
+    return (np.argsort(key, axis=1) + offset) % n
+
+
+# state shared with the worker processes (sent once per worker)
+_series = None
+
+
+def _init_series(starts, values):
+    global _series
+    _series = (starts, values)
+
+
+def _resample_chunk(i, size, block, seed):
+    """Bootstrap correlations and permutation exceedance counts for `size` resamples of ticker i."""
+    starts, values = _series
+    rng = np.random.default_rng(seed)
+    n = starts[i + 1] - starts[i]
+    boot_idx = bootstrap_indices(n, block, size, rng)
+    perm_idx = permutation_indices(n, block, size, rng)
+    boot, exceed = [], []
+    for x_col, y_col in PAIRS:
+        x = values[x_col][starts[i]:starts[i + 1]]
+        y = values[y_col][starts[i]:starts[i + 1]]
+        (_, x_codes), (_, y_codes) = np.unique(x, return_inverse=True), np.unique(y, return_inverse=True)
+        x_rank, y_rank = stats.rankdata(x), stats.rankdata(y)
+        boot.append(row_corr(x[boot_idx], y[boot_idx]))
+        boot.append(row_corr(resample_ranks(x_codes, x_codes.max() + 1, boot_idx),
+                             resample_ranks(y_codes, y_codes.max() + 1, boot_idx)))
+        # permuting y keeps every value, so the spearman ranks are the original ones permuted and
+        # the means and norms don't change: each permuted correlation is one dot product
+        for x_obs, y_obs in [(x, y), (x_rank, y_rank)]:
+            xc, yc = x_obs - x_obs.mean(), y_obs - y_obs.mean()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                norm = np.sqrt((xc @ xc) * (yc @ yc))
+                r_obs = (xc @ yc) / norm
+                r_perm = (yc[perm_idx] @ xc) / norm
+            # NaN (no variance) never counts as extreme
+            exceed.append(np.sum(np.abs(r_perm) >= np.abs(r_obs) - 1e-12))
+    return i, np.array(boot), np.array(exceed)
+
+
+def resample_correlations(data, n_resamples=10000, block=None, chunk=2000, workers=None, seed=0, alpha=0.05):
+    """Block bootstrap confidence intervals and block permutation p-values for every ticker and PAIRS.
+
+    Each ticker's rows are resampled `chunk` at a time as (chunk, n) index arrays, so memory stays
+    at a few chunk * n arrays no matter how many resamples are asked for. Every (ticker, chunk)
+    gets its own seed, so results don't depend on the number of workers.
+    """
+    cols = sorted({c for pair in PAIRS for c in pair})
+    data = data.dropna(subset=cols).sort_values(['ticker', 'Date'])
+    codes, tickers = pd.factorize(data['ticker'], sort=True)
+    counts = np.bincount(codes, minlength=len(tickers))
+    starts = np.concatenate([[0], np.cumsum(counts)])
+    values = {c: data[c].to_numpy(dtype=float) for c in cols}
+    blocks = [block or default_block(n) for n in counts]
+
+    tasks = []
+    seeds = np.random.SeedSequence(seed).spawn(len(tickers))
+    for i, ticker_seed in enumerate(seeds):
+        if counts[i] < 3:
+            continue
+        sizes = [min(chunk, n_resamples - s) for s in range(0, n_resamples, chunk)]
+        for size, chunk_seed in zip(sizes, ticker_seed.spawn(len(sizes))):
+            tasks.append((i, size, blocks[i], chunk_seed))
+
+    if workers == 1 or len(tasks) <= 1:
+        _init_series(starts, values)
+        parts = [_resample_chunk(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_series, initargs=(starts, values)) as pool:
+            parts = list(pool.map(_resample_chunk, *zip(*tasks)))
+
+    boot, exceed = {}, {}
+    for i, b, e in parts:
+        boot.setdefault(i, []).append(b)
+        exceed[i] = exceed.get(i, 0) + e
+
+    rows = []
+    for i in boot:
+        b = np.concatenate(boot[i], axis=1)
+        k = 0
+        for x_col, y_col in PAIRS:
+            x = values[x_col][starts[i]:starts[i + 1]]
+            y = values[y_col][starts[i]:starts[i + 1]]
+            for method, test in zip(METHODS, [stats.pearsonr, stats.spearmanr]):
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    r, p = test(x, y) if np.ptp(x) > 0 and np.ptp(y) > 0 else (np.nan, np.nan)
+                ok = b[k][~np.isnan(b[k])]
+                low, high = np.quantile(ok, [alpha / 2, 1 - alpha / 2]) if len(ok) else (np.nan, np.nan)
+                p_perm = (1 + exceed[i][k]) / (1 + n_resamples) if not np.isnan(r) else np.nan
+                rows.append((tickers[i], x_col, y_col, method, counts[i], blocks[i], r, low, high, p, p_perm))
+                k += 1
+    return pd.DataFrame(rows, columns=RESULT_COLS)
+
+
+def main(tickers=None, n_resamples=10000, block=None, workers=None, seed=0):
+    os.makedirs('stats', exist_ok=True)
+
+    cols = sorted({c for pair in PAIRS for c in pair})
+    data = read_table('merge_cleaned/dataset', columns=['Date'] + cols, tickers=tickers)
+    with section('resampling.correlations', rows=len(data)):
+        results = resample_correlations(data, n_resamples=n_resamples, block=block, workers=workers, seed=seed)
+    results.to_csv('stats/resampling_results.csv', index=False)
+
+    # print results
+    for (x_col, y_col, method), group in results.groupby(['x', 'y', 'method'], sort=False):
+        print(f'{x_col} vs {y_col} ({method}), 95% block bootstrap CI and block permutation p:')
+        for row in group.itertuples():
+            print(f'  {row.ticker}: r={row.r:.3f} [{row.ci_low:.3f}, {row.ci_high:.3f}], '
+                  f'p_perm={row.p_perm:.3g} (asymptotic {row.p_asymptotic:.3g})')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    # defaults to every ticker in the dataset
+    parser.add_argument('--tickers', nargs='+')
+    parser.add_argument('--resamples', type=int, default=10000)
+    # days per block, defaults to n^(1/3) for each ticker
+    parser.add_argument('--block', type=int)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    with profile_stage('resampling'):
+        main(tickers=args.tickers, n_resamples=args.resamples, block=args.block, workers=args.workers, seed=args.seed)
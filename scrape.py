@@ -1,8 +1,19 @@
 import pandas as pd
-import yfinance as yf
 import praw
-from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+import prawcore
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
+from prices import FixtureProvider, PriceStore
+from profiling import profile_stage, section
+from sentiment import SentimentCache, SentimentScorer
+from storage import write_table
+from store import RedditStore
+import argparse
+import itertools
+import json
+import os
+import random
+import threading
 import time
 
 # reddit api scrape
@@ -13,118 +24,408 @@ reddit = praw.Reddit(
     user_agent="testagent/0.1"
 )
 
-# analyze comments
-# reference: https://medium.com/@rslavanyageetha/vader-a-comprehensive-guide-to-sentiment-analysis-in-python-c4f1868b0d2e
-# reference: https://github.com/cjhutto/vaderSentiment
-analyzer = SentimentIntensityAnalyzer()
-
 wsb = reddit.subreddit('wallstreetbets')
 
-def main():
-    # reference: https://ranaroussi.github.io/yfinance/reference/index.html
-    # getting $GME data from yfinance
-    print("Grabbing $GME data")
-    gme = yf.download('GME', start='2021-01-01', end='2021-03-31', auto_adjust=True)
-    gme = gme.reset_index()
-    gme['ticker'] = 'GME'
-    gme.to_csv('scrape_stock/stock_data_GME.csv', index=False)
-    print("finished $GME data")
-
-    # getting $OPEN data from yfinance
-    print("Grabbing $OPEN data")
-    open_stock = yf.download('OPEN', start='2025-05-15', end='2025-08-10', auto_adjust=True)
-    open_stock = open_stock.reset_index()
-    open_stock['ticker'] = 'OPEN'
-    open_stock.to_csv('scrape_stock/stock_data_OPEN.csv', index=False)
-    print("finished $OPEN data")
-
-    # stores Reddit data
-    all_data = []
-    
-    print("GME Reddit Scrape")
-    count = 0
-    # reference: https://praw.readthedocs.io/en/stable/code_overview/models/subreddit.html#praw.models.Subreddit.search
-    # set to time_filter='all because GME was popular in 2021 and having same parameter as a recent ticker was not scraping data properly
-    for submission in wsb.search('GME', time_filter='all', limit=150):
-        created = datetime.fromtimestamp(submission.created_utc)
-        # needs extra layer filter due to time_filter='all'
-        if created.year == 2021 and created.month <= 3:
-            sentiment = analyzer.polarity_scores(submission.title)
-            all_data.append({
-                'date': created.strftime('%Y-%m-%d'),
-                'ticker': 'GME',
-                'type': 'post',
-                'score': submission.score,
-                'num_comments': submission.num_comments,
-                'sentiment': sentiment['compound']
+# a praw.Reddit isn't thread-safe (its requests session and its own rate limiter aren't locked),
+# so every scrape thread gets its own client with the same credentials
+# reference: https://praw.readthedocs.io/en/stable/getting_started/multiple_instances.html
+_thread = threading.local()
+
+
+def thread_reddit():
+    """This thread's own praw client, made on first use."""
+    client = getattr(_thread, 'reddit', None)
+    if client is None:
+        client = _thread.reddit = praw.Reddit(client_id=reddit.config.client_id,
+                                              client_secret=reddit.config.client_secret,
+                                              user_agent=reddit.config.user_agent)
+    return client
+
+
+# one entry per ticker: the yfinance window (start/end) and the reddit search for it
+# GME is set to time_filter='all' because GME was popular in 2021 and having same parameter as a recent ticker was not scraping data properly,
+# so it needs the extra filter_posts layer to keep only posts inside start/end
+# OPEN is set to time_filter='month' because OPEN is more recent stock and anything other than this filter also wouldn't scrape data properly
+DEFAULT_CONFIG = [
+    {'ticker': 'GME', 'time_filter': 'all', 'start': '2021-01-01', 'end': '2021-03-31', 'filter_posts': True},
+    {'ticker': 'OPEN', 'time_filter': 'month', 'start': '2025-05-15', 'end': '2025-08-10'},
+]
+# used for anything an entry leaves out ('query' defaults to the ticker itself)
+# sort='new' lets reruns stop at the ticker's high-water mark instead of re-listing old posts
+CONFIG_DEFAULTS = {'sort': 'relevance', 'time_filter': 'all', 'limit': 150, 'filter_posts': False}
+
+# posts per listing request (reddit's maximum)
+LISTING_PAGE = 100
+
+# errors worth retrying: rate limited (429), reddit server errors (5xx) and dropped connections
+# reference: https://prawcore.readthedocs.io/en/stable/
+RETRY_ERRORS = (
+    prawcore.exceptions.TooManyRequests,
+    prawcore.exceptions.ServerError,
+    prawcore.exceptions.RequestException,
+)
+
+
+class TokenBucket:
+    """Thread-safe token bucket shared by every scrape worker.
+
+    Starts at `rate` requests/sec and, when `limits` is given, re-syncs after each
+    request from Reddit's rate-limit headers so the workers together never go past
+    what is left in the current window.
+    """
+
+    def __init__(self, rate=1.0, capacity=10, limits=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.limits = limits
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def sync(self):
+        # praw keeps the last x-ratelimit-remaining / x-ratelimit-reset headers in reddit.auth.limits
+        # reference: https://praw.readthedocs.io/en/stable/code_overview/other/auth.html#praw.models.Auth.limits
+        if self.limits is None:
+            return
+        limits = self.limits()
+        remaining = limits.get('remaining')
+        reset = limits.get('reset_timestamp')
+        if remaining is None or reset is None:
+            return
+        seconds_left = max(reset - time.time(), 1.0)
+        with self.lock:
+            # spread what is left evenly over the rest of the window (at least 1 request once it resets)
+            self.rate = max(remaining, 1) / seconds_left
+            self.tokens = min(self.tokens, remaining)
+
+
+def with_retry(fn, retries=4, backoff=1.0, retry_on=RETRY_ERRORS):
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except retry_on:
+            if attempt == retries:
+                raise
+            # exponential backoff with jitter so workers don't retry in lockstep
+            time.sleep(backoff * 2 ** attempt + random.uniform(0, backoff))
+
+
+def fetch_submission(submission, tickers, limiter, client=None):
+    """Fetch one submission's top 3 comments and emit its rows once per matching ticker.
+
+    Rows carry the raw 'text' to score; sentiment is filled in later by score_records.
+    With a `client` (like thread_reddit) the comment tree is loaded through the calling
+    thread's own client instead of the one the search listing came from.
+    """
+    created = datetime.fromtimestamp(submission.created_utc)
+    date = created.strftime('%Y-%m-%d')
+    posts = [{
+        'id': submission.id,
+        'submission_id': submission.id,
+        'date': date,
+        'created_utc': submission.created_utc,
+        'type': 'post',
+        'score': submission.score,
+        'num_comments': submission.num_comments,
+        'text': submission.title
+    }]
+
+    # getting top 3 comments (this is the request that loads the comment tree)
+    tree = client().submission(id=submission.id) if client else submission
+    limiter.acquire()
+    with_retry(lambda: tree.comments.replace_more(limit=0))
+    limiter.sync()
+    for comment in list(tree.comments)[:3]:
+        if hasattr(comment, 'body'):
+            posts.append({
+                'id': comment.id,
+                'submission_id': submission.id,
+                # comments are counted on the day of their post, but keep their own timestamp
+                'date': date,
+                'created_utc': getattr(comment, 'created_utc', submission.created_utc),
+                'type': 'comment',
+                'score': comment.score,
+                'num_comments': 0,
+                # max 500 characters to reduce scoring time
+                'text': comment.body[:500]
             })
-            
-            # getting top 3 comments
-            submission.comments.replace_more(limit=0)
-            for comment in list(submission.comments)[:3]:
-                if hasattr(comment, 'body'):
-                    # max 500 characters to reduce scraping time
-                    comment_sentiment = analyzer.polarity_scores(comment.body[:500])
-                    all_data.append({
-                        'date': created.strftime('%Y-%m-%d'),
-                        'ticker': 'GME',
-                        'type': 'comment',
-                        'score': comment.score,
-                        'num_comments': 0,
-                        'sentiment': comment_sentiment['compound']
-                    })
-            
-            count += 1
-            time.sleep(0.2)
-    print("GME scrape finished.")
-    
-    # OPEN data from recent posts
-    print("OPEN Reddit Scrape")
-    count = 0
-    # set to time_filter='month' because OPEN is more recent stock and anything other than this filter also wouldn't scrape data properly
-    for submission in wsb.search('OPEN', time_filter='month', limit=150):
-        created = datetime.fromtimestamp(submission.created_utc)
-        sentiment = analyzer.polarity_scores(submission.title)
-        all_data.append({
-            'date': created.strftime('%Y-%m-%d'),
-            'ticker': 'OPEN',
-            'type': 'post',
-            'score': submission.score,
-            'num_comments': submission.num_comments,
-            'sentiment': sentiment['compound']
-        })
-
-        # getting top 3 comments
-        submission.comments.replace_more(limit=0)
-        for comment in list(submission.comments)[:3]:
-            if hasattr(comment, 'body'):
-                # max 500 characters to reduce scraping time
-                comment_sentiment = analyzer.polarity_scores(comment.body[:500])
-                all_data.append({
-                    'date': created.strftime('%Y-%m-%d'),
-                    'ticker': 'OPEN',
-                    'type': 'comment',
-                    'score': comment.score,
-                    'num_comments': 0,
-                    'sentiment': comment_sentiment['compound']
-                })
-        
-        count += 1
-        time.sleep(0.2)
-    print("OPEN scrape finished.")
+    return [{**row, 'ticker': ticker} for ticker in tickers for row in posts]
+
+
+def iter_submissions(matches, workers=8, limiter=None, client=None):
+    """Fetch comment trees for many submissions in parallel, yielding each one's rows as it finishes.
+
+    `matches` is an iterable of (submission, tickers) pairs where the submissions can be
+    any praw-like objects (so a local fake works for testing). Only a few submissions per
+    worker are in flight at once, so memory doesn't grow with the number of posts.
+    Prints posts/sec at the end so runs with workers=1 (the old serial loop) can be compared.
+    """
+    limiter = limiter or TokenBucket()
+    matches = iter(matches)
+    start = time.perf_counter()
+    done = 0
+    # reference: https://docs.python.org/3/library/concurrent.futures.html#threadpoolexecutor
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = set()
+        while True:
+            for submission, tickers in itertools.islice(matches, workers * 4 - len(in_flight)):
+                in_flight.add(pool.submit(fetch_submission, submission, tickers, limiter, client))
+            if not in_flight:
+                break
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                done += 1
+                yield future.result()
+    elapsed = time.perf_counter() - start
+    rate = done / elapsed if elapsed > 0 else float('inf')
+    print(f'{done} posts in {elapsed:.1f}s ({rate:.1f} posts/sec, {workers} workers)')
+
+
+def scrape_submissions(matches, workers=8, limiter=None, client=None):
+    return [row for rows in iter_submissions(matches, workers=workers, limiter=limiter, client=client) for row in rows]
+
+
+def score_records(records, scorer):
+    """Replace each record's 'text' with its VADER compound score, one batch at a time."""
+    scores = scorer.score([r.pop('text') for r in records])
+    for record, score in zip(records, scores):
+        record['sentiment'] = score
+    return records
+
+
+def iter_scored(row_groups, scorer, batch_size=2000):
+    """Regroup fetched rows into batches of about `batch_size` and yield them scored."""
+    pending = []
+    for rows in row_groups:
+        pending.extend(rows)
+        if len(pending) >= batch_size:
+            yield score_records(pending, scorer)
+            pending = []
+    if pending:
+        yield score_records(pending, scorer)
+
+
+class DailyAggregator:
+    """Running per-(date, ticker) sentiment sum and count, the streaming version of the daily groupby."""
+
+    def __init__(self, daily=None):
+        self.totals = {}
+        # start from an existing daily table (e.g. the store's) so flushes include earlier runs
+        if daily is not None:
+            for row in daily.itertuples(index=False):
+                self.totals[(row.date, row.ticker)] = [row.avg_sentiment * row.mention_count, row.mention_count]
+
+    def add(self, records):
+        for r in records:
+            total = self.totals.setdefault((r['date'], r['ticker']), [0.0, 0])
+            total[0] += r['sentiment']
+            total[1] += 1
+
+    def frame(self):
+        rows = [(date, ticker, s / n, n) for (date, ticker), (s, n) in sorted(self.totals.items())]
+        return pd.DataFrame(rows, columns=['date', 'ticker', 'avg_sentiment', 'mention_count'])
+
+    def flush(self, path):
+        # write to a temp file and swap it in so readers never see a half-written csv
+        self.frame().to_csv(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+
+
+def load_config(path=None):
+    """Read the scrape config (a JSON list of ticker entries) and fill in defaults."""
+    config = DEFAULT_CONFIG
+    if path is not None:
+        with open(path) as f:
+            config = json.load(f)
+    return [{**CONFIG_DEFAULTS, 'query': entry['ticker'], **entry} for entry in config]
+
+
+def search_ticker(subreddit, entry, watermark=None, client=None, limiter=None):
+    """Run one ticker's search and keep the submissions inside its date window (no comment fetches)."""
+    if client is not None:
+        subreddit = client().subreddit(subreddit.display_name)
+    # listings come 100 posts per request (limit=None lists up to 1000), all of them go through the
+    # shared limiter like the comment fetches
+    pages = -(-(entry['limit'] or 1000) // LISTING_PAGE)
+
+    def search():
+        if limiter is not None:
+            for _ in range(pages):
+                limiter.acquire()
+        found = []
+        # reference: https://praw.readthedocs.io/en/stable/code_overview/models/subreddit.html#praw.models.Subreddit.search
+        for s in subreddit.search(entry['query'], sort=entry['sort'], time_filter=entry['time_filter'], limit=entry['limit']):
+            # 'new' listings are newest first, so everything past the high-water mark is already stored
+            if entry['sort'] == 'new' and watermark is not None and s.created_utc <= watermark:
+                break
+            found.append(s)
+        if limiter is not None:
+            limiter.sync()
+        return found
+
+    found = with_retry(search)
+    if not entry['filter_posts']:
+        return found
+    return [s for s in found
+            if entry['start'] <= datetime.fromtimestamp(s.created_utc).strftime('%Y-%m-%d') <= entry['end']]
+
+
+def find_submissions(subreddit, config, search_workers=4, store=None, client=None, limiter=None):
+    """Search every ticker in parallel and return the (submission, tickers) pairs still to fetch
+    and the newest post listed for each ticker.
+
+    The same post can match several tickers, so each distinct submission shows up once.
+    With a `store`, submissions already saved for a ticker are left out.
+    """
+    watermarks = {entry['ticker']: store.watermark(entry['ticker']) if store else None for entry in config}
+    with ThreadPoolExecutor(max_workers=search_workers) as pool:
+        results = list(pool.map(lambda entry: search_ticker(subreddit, entry, watermarks[entry['ticker']], client, limiter), config))
+
+    matches = {}
+    skipped = 0
+    newest = {entry['ticker']: max(s.created_utc for s in submissions)
+              for entry, submissions in zip(config, results) if submissions}
+    for entry, submissions in zip(config, results):
+        known = store.known_submissions(entry['ticker']) if store else set()
+        print(f"{entry['ticker']}: {len(submissions)} posts found, {len(known)} already stored")
+        for submission in submissions:
+            if submission.id in known:
+                skipped += 1
+                continue
+            matches.setdefault(submission.id, (submission, []))[1].append(entry['ticker'])
+    duplicates = sum(len(r) for r in results) - skipped - len(matches)
+    print(f'{len(matches)} new posts to fetch ({duplicates} duplicates skipped)')
+    return list(matches.values()), newest
+
+
+def scrape_tickers(subreddit, config, workers=8, search_workers=4, limiter=None, store=None,
+                   scorer=None, score_batch=2000, client=None):
+    """Search every ticker, fetch each distinct submission once and return the scored records.
+
+    Fetched rows are scored in batches of `score_batch` by the sentiment stage rather than
+    inside the network loop. With a `store`, each scored batch is committed as a checkpoint,
+    so reruns only fetch the delta.
+    """
+    limiter = limiter or TokenBucket()
+    matches, newest = find_submissions(subreddit, config, search_workers=search_workers, store=store, client=client,
+                                       limiter=limiter)
+    records = []
+    for batch in iter_scored(iter_submissions(matches, workers=workers, limiter=limiter, client=client),
+                             scorer or SentimentScorer(), batch_size=score_batch):
+        if store is not None:
+            store.add(batch)
+        records.extend(batch)
+    # only now is every listed post stored, a crash before this keeps the old marks
+    if store is not None:
+        store.advance_watermarks(newest)
+    return records
+
+
+def stream_tickers(subreddit, config, store, daily_path, workers=8, search_workers=4, limiter=None,
+                   scorer=None, score_batch=2000, flush_every=5, client=None):
+    """Streaming version of scrape_tickers that never holds the whole scrape in memory.
+
+    Each scored batch goes straight to the store and into running daily aggregates, and
+    the daily csv at `daily_path` is rewritten every `flush_every` batches so it can be
+    used while the scrape is still running.
+    """
+    limiter = limiter or TokenBucket()
+    matches, newest = find_submissions(subreddit, config, search_workers=search_workers, store=store, client=client,
+                                       limiter=limiter)
+    daily = DailyAggregator(store.daily())
+    batches = iter_scored(iter_submissions(matches, workers=workers, limiter=limiter, client=client),
+                          scorer or SentimentScorer(), batch_size=score_batch)
+    for i, batch in enumerate(batches, start=1):
+        store.add(batch)
+        daily.add(batch)
+        if i % flush_every == 0:
+            daily.flush(daily_path)
+    daily.flush(daily_path)
+    store.advance_watermarks(newest)
+
+
+def main(config_path=None, workers=8, search_workers=4, score_workers=None, stream=False, csv=False, prices_fixture=None):
+    os.makedirs('scrape_stock', exist_ok=True)
+    config = load_config(config_path)
+
+    # getting price data, cached locally so only date ranges not seen before are downloaded
+    # (from yfinance in batches of tickers, or from a local fixture file when offline)
+    provider = FixtureProvider(prices_fixture) if prices_fixture else None
+    with section('scrape.prices') as s:
+        price_store = PriceStore(provider=provider)
+        prices = price_store.load({entry['ticker']: (entry['start'], entry['end']) for entry in config})
+        price_store.close()
+        write_table(prices, 'scrape_stock/prices', csv=csv)
+        s.rows = len(prices)
+    print("finished price data")
+
+    # one limiter shared by every worker so the whole scrape stays under reddit's limit
+    # (the rate-limit headers come from whichever thread's client made the last request)
+    limiter = TokenBucket(limits=lambda: thread_reddit().auth.limits)
+
+    # stores Reddit data, new rows are appended to what earlier runs already saved
+    store = RedditStore()
+    # analyze posts and comments
+    # reference: https://medium.com/@rslavanyageetha/vader-a-comprehensive-guide-to-sentiment-analysis-in-python-c4f1868b0d2e
+    scorer = SentimentScorer(cache=SentimentCache(), workers=score_workers)
+    print("Reddit Scrape")
+    # fetching and scoring are interleaved, sentiment.score sections show the scoring share
+    with section('scrape.reddit'):
+        if stream:
+            # daily file is kept up to date during the scrape instead of only at the end
+            # (the in-progress flushes are csv, the parquet table below is written once it finishes)
+            stream_tickers(wsb, config, store, 'scrape_stock/reddit_daily.csv', workers=workers, search_workers=search_workers,
+                           limiter=limiter, scorer=scorer, client=thread_reddit)
+        else:
+            scrape_tickers(wsb, config, workers=workers, search_workers=search_workers, limiter=limiter, store=store,
+                           scorer=scorer, client=thread_reddit)
+        scorer.close()
+    print("Reddit scrape finished.")
 
     # all the data scraped in one file
-    df = pd.DataFrame(all_data)
-    df.to_csv('scrape_stock/reddit_raw.csv', index=False)
+    with section('scrape.write_raw') as s:
+        raw = store.raw()
+        raw['date'] = pd.to_datetime(raw['date'])
+        write_table(raw, 'scrape_stock/reddit_raw', csv=csv)
+        s.rows = len(raw)
     print("raw file data completed")
-    
+
     # since there is more than one posts a day when it is scraped it will group the day to daily so it's easier to read
-    daily = df.groupby(['date', 'ticker']).agg({
-        'sentiment': ['mean', 'count']
-    }).reset_index()
-    daily.columns = ['date', 'ticker', 'avg_sentiment', 'mention_count']
-    daily.to_csv('scrape_stock/reddit_daily.csv', index=False)
+    daily = store.daily()
+    daily['date'] = pd.to_datetime(daily['date'])
+    write_table(daily, 'scrape_stock/reddit_daily', csv=csv)
     print("daily file data completed")
+    store.close()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    # JSON list like DEFAULT_CONFIG, e.g. [{"ticker": "AMC", "start": "2021-01-01", "end": "2021-06-30"}]
+    parser.add_argument('--config')
+    # --workers 1 behaves like the old serial loop
+    parser.add_argument('--workers', type=int, default=8)
+    # threads running the per-ticker searches (their requests share the same limiter)
+    parser.add_argument('--search-workers', type=int, default=4)
+    # processes used to score sentiment (defaults to one per core)
+    parser.add_argument('--score-workers', type=int)
+    # constant-memory mode for big scrapes, reddit_daily.csv is refreshed as batches finish
+    parser.add_argument('--stream', action='store_true')
+    # also export the tables as csv next to the parquet folders
+    parser.add_argument('--csv', action='store_true')
+    # read prices from a local parquet/csv file of bars instead of yfinance
+    parser.add_argument('--prices-fixture')
+    args = parser.parse_args()
+    with profile_stage('scrape'):
+        main(config_path=args.config, workers=args.workers, search_workers=args.search_workers,
+             score_workers=args.score_workers, stream=args.stream, csv=args.csv, prices_fixture=args.prices_fixture)
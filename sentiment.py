@@ -0,0 +1,122 @@
+import hashlib
+import multiprocessing
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from profiling import section
+from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+
+# reference: https://github.com/cjhutto/vaderSentiment
+# reference: https://docs.python.org/3/library/concurrent.futures.html#processpoolexecutor
+
+# each worker process builds its own analyzer once (loading the lexicon is the slow part)
+_analyzer = None
+
+
+def _init_worker():
+    global _analyzer
+    _analyzer = SentimentIntensityAnalyzer()
+
+
+def _score_chunk(texts):
+    if _analyzer is None:
+        _init_worker()
+    return [_analyzer.polarity_scores(t)['compound'] for t in texts]
+
+
+def text_key(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class SentimentCache:
+    """On-disk cache of VADER compound scores keyed by a hash of the text.
+
+    Reposts, copypasta and bot comments hash to the same key so they are only scored
+    once, and the least recently used entries are evicted past `max_entries`.
+    """
+
+    def __init__(self, path='scrape_stock/sentiment_cache.db', max_entries=1_000_000):
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS scores (key TEXT PRIMARY KEY, compound REAL NOT NULL, last_used INTEGER NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used)')
+        # a counter instead of wall time so entries touched in the same batch keep their order
+        self.clock = self.conn.execute('SELECT COALESCE(MAX(last_used), 0) FROM scores').fetchone()[0]
+
+    def get_many(self, keys):
+        found = {}
+        self.clock += 1
+        # sqlite limits the number of ? parameters, so look keys up in chunks
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            marks = ', '.join('?' * len(chunk))
+            found.update(self.conn.execute(f'SELECT key, compound FROM scores WHERE key IN ({marks})', chunk))
+            self.conn.execute(f'UPDATE scores SET last_used = ? WHERE key IN ({marks})', [self.clock, *chunk])
+        self.conn.commit()
+        return found
+
+    def put_many(self, scores):
+        self.clock += 1
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO scores (key, compound, last_used) VALUES (?, ?, ?)',
+                                  [(k, v, self.clock) for k, v in scores.items()])
+            extra = self.conn.execute('SELECT COUNT(*) FROM scores').fetchone()[0] - self.max_entries
+            if extra > 0:
+                self.conn.execute('DELETE FROM scores WHERE key IN (SELECT key FROM scores ORDER BY last_used LIMIT ?)', (extra,))
+
+    def close(self):
+        self.conn.close()
+
+
+class SentimentScorer:
+    """Scores batches of texts, checking the cache first and spreading misses over a process pool.
+
+    Small batches are scored in-process since starting the pool costs more than scoring them.
+    """
+
+    def __init__(self, cache=None, workers=None, chunksize=500):
+        self.cache = cache
+        self.workers = workers
+        self.chunksize = chunksize
+        self.pool = None
+
+    def score(self, texts):
+        with section('sentiment.score', rows=len(texts)):
+            keys = [text_key(t) for t in texts]
+            scores = self.cache.get_many(list(set(keys))) if self.cache is not None else {}
+
+            # identical texts in the same batch are only scored once as well
+            missing = {}
+            for k, t in zip(keys, texts):
+                if k not in scores:
+                    missing[k] = t
+            if missing:
+                with section('sentiment.vader', rows=len(missing)):
+                    new_scores = dict(zip(missing, self._score_uncached(list(missing.values()))))
+                if self.cache is not None:
+                    self.cache.put_many(new_scores)
+                scores.update(new_scores)
+            return [scores[k] for k in keys]
+
+    def _score_uncached(self, texts):
+        if len(texts) <= self.chunksize or self.workers == 1:
+            return _score_chunk(texts)
+        if self.pool is None:
+            # spawn so the pool is safe to start from a process that already has scrape threads running
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                            mp_context=multiprocessing.get_context('spawn'))
+        chunks = [texts[i:i + self.chunksize] for i in range(0, len(texts), self.chunksize)]
+        return [s for chunk in self.pool.map(_score_chunk, chunks) for s in chunk]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+def score_texts(texts, cache=None, workers=None):
+    scorer = SentimentScorer(cache=cache, workers=workers)
+    try:
+        return scorer.score(texts)
+    finally:
+        scorer.close()
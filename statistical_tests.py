@@ -1,113 +1,276 @@
 import pandas as pd
+import numpy as np
 from scipy import stats
 from statsmodels.stats.multicomp import pairwise_tukeyhsd
+from statsmodels.stats.multitest import multipletests
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import multiprocessing
 import os
+from profiling import profile_stage, section
+from storage import read_table
+
+# metrics compared between every pair of tickers
+PAIR_METRICS = ['vol_5d', 'mention_count']
+RESULT_COLS = ['test', 'metric', 'ticker_a', 'ticker_b', 'n_a', 'n_b', 'statistic', 'p_value', 'p_adj', 'significant']
+
+
+def grouped_moments(values, codes, n_groups):
+    """Count, mean and biased 2nd-4th central moments of `values` for every group at once."""
+    n = np.bincount(codes, minlength=n_groups).astype(float)
+    mean = np.bincount(codes, values, n_groups) / n
+    d = values - mean[codes]
+    m2, m3, m4 = (np.bincount(codes, d ** k, n_groups) / n for k in (2, 3, 4))
+    return n, mean, m2, m3, m4
+
+
+def normaltest(n, m2, m3, m4):
+    """D'Agostino-Pearson K^2 for many groups at once from their moments (same formulas as scipy.stats.normaltest)."""
+    # reference: https://github.com/scipy/scipy/blob/main/scipy/stats/_stats_py.py (skewtest, kurtosistest)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        skew = m3 / m2 ** 1.5
+        y = skew * np.sqrt((n + 1) * (n + 3) / (6.0 * (n - 2)))
+        beta2 = 3.0 * (n ** 2 + 27 * n - 70) * (n + 1) * (n + 3) / ((n - 2.0) * (n + 5) * (n + 7) * (n + 9))
+        w2 = -1 + np.sqrt(2 * (beta2 - 1))
+        delta = 1 / np.sqrt(0.5 * np.log(w2))
+        alpha = np.sqrt(2.0 / (w2 - 1))
+        y = np.where(y == 0, 1, y)
+        z_skew = delta * np.log(y / alpha + np.sqrt((y / alpha) ** 2 + 1))
+
+        kurt = m4 / m2 ** 2
+        e = 3.0 * (n - 1) / (n + 1)
+        varb2 = 24.0 * n * (n - 2) * (n - 3) / ((n + 1) * (n + 1.0) * (n + 3) * (n + 5))
+        x = (kurt - e) / np.sqrt(varb2)
+        sqrtbeta1 = 6.0 * (n * n - 5 * n + 2) / ((n + 7) * (n + 9)) * np.sqrt(6.0 * (n + 3) * (n + 5) / (n * (n - 2) * (n - 3)))
+        a = 6.0 + 8.0 / sqrtbeta1 * (2.0 / sqrtbeta1 + np.sqrt(1 + 4.0 / sqrtbeta1 ** 2))
+        denom = 1 + x * np.sqrt(2 / (a - 4.0))
+        term2 = np.sign(denom) * np.where(denom == 0.0, np.nan, ((1 - 2.0 / a) / np.abs(denom)) ** (1 / 3.0))
+        z_kurt = (1 - 2 / (9.0 * a) - term2) / np.sqrt(2 / (9.0 * a))
+
+        k2 = z_skew ** 2 + z_kurt ** 2
+    # scipy needs at least 8 values
+    k2 = np.where(n >= 8, k2, np.nan)
+    return k2, stats.chi2.sf(k2, 2)
+
+
+def grouped_spearman(x, y, codes, n_groups):
+    """Spearman correlation of x and y inside every group, with scipy's t-distribution p-value."""
+    frame = pd.DataFrame({'x': x, 'y': y, 'g': codes})
+    rx = frame.groupby('g')['x'].rank().to_numpy()
+    ry = frame.groupby('g')['y'].rank().to_numpy()
+    # pearson on the ranks from grouped sums
+    n, mx, vx, _, _ = grouped_moments(rx, codes, n_groups)
+    _, my, vy, _, _ = grouped_moments(ry, codes, n_groups)
+    cov = np.bincount(codes, (rx - mx[codes]) * (ry - my[codes]), n_groups) / n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = np.clip(cov / np.sqrt(vx * vy), -1, 1)
+        t = r * np.sqrt((n - 2) / ((1 - r) * (1 + r)))
+    return n, r, 2 * stats.t.sf(np.abs(t), n - 2)
+
+
+def pairwise_levene(values, codes, n_groups):
+    """Levene's test (median centred, like scipy's default) for every pair of groups at once."""
+    med = pd.Series(values).groupby(codes).median().reindex(range(n_groups)).to_numpy()
+    z = np.abs(values - med[codes])
+    n, zbar, zvar, _, _ = grouped_moments(z, codes, n_groups)
+    ss = zvar * n
+    a, b = np.triu_indices(n_groups, k=1)
+    total = n[a] + n[b]
+    grand = (n[a] * zbar[a] + n[b] * zbar[b]) / total
+    between = n[a] * (zbar[a] - grand) ** 2 + n[b] * (zbar[b] - grand) ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = (total - 2) * between / (ss[a] + ss[b])
+    return a, b, w, stats.f.sf(w, 1, total - 2)
+
+
+# state shared with the mann-whitney worker processes (sent once per worker)
+_mw = None
+
+
+def _init_mann_whitney(keys, starts, ranks, own_ties, tie_sums, stride):
+    global _mw
+    _mw = (keys, starts, ranks, own_ties, tie_sums, stride)
+
+
+def _mann_whitney_rows(first, last):
+    """U statistic and tie term of groups first..last-1 against every later group."""
+    keys, starts, ranks, own_ties, tie_sums, stride = _mw
+    n_groups = len(starts) - 1
+    out = []
+    for i in range(first, last):
+        r = ranks[starts[i]:starts[i + 1]]
+        a = own_ties[starts[i]:starts[i + 1]]
+        others = np.arange(i + 1, n_groups)
+        if len(others) == 0 or len(r) == 0:
+            continue
+        # one searchsorted answers "how many values of group j are below / equal to x" for every j and x
+        query = others[:, None] * stride + r[None, :]
+        below = np.searchsorted(keys, query, 'left') - starts[others][:, None]
+        equal = np.searchsorted(keys, query, 'right') - starts[others][:, None] - below
+        u = below.sum(axis=1) + 0.5 * equal.sum(axis=1)
+        # sum over tied values of (t^3 - t) in the combined sample, from the per-value counts
+        ties = tie_sums[i] + tie_sums[others] + 3 * (equal * a[None, :]).sum(axis=1) + 3 * (equal ** 2).sum(axis=1)
+        out.append((np.full(len(others), i), others, u, ties))
+    if not out:
+        return (np.array([], dtype=int),) * 2 + (np.array([]),) * 2
+    return tuple(np.concatenate(col) for col in zip(*out))
+
+
+def pairwise_mann_whitney(values, codes, n_groups, workers=None, chunk=16):
+    """Two-sided Mann-Whitney U (normal approximation with tie and continuity correction) for every pair of groups.
+
+    Values are replaced by their global dense rank and every group's sorted ranks are laid
+    end to end with a per-group offset, so each group is compared with all later groups in a
+    single vectorized searchsorted. Blocks of groups are spread over worker processes.
+    """
+    # reference: https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.mannwhitneyu.html
+    order = np.lexsort((values, codes))
+    codes, values = codes[order], values[order]
+    _, ranks = np.unique(values, return_inverse=True)
+    stride = ranks.max() + 2
+    keys = codes.astype(np.int64) * stride + ranks
+    starts = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=n_groups))])
+    own_ties = np.searchsorted(keys, keys, 'right') - np.searchsorted(keys, keys, 'left')
+    tie_sums = np.bincount(codes, own_ties.astype(float) ** 2 - 1, n_groups)
+    state = (keys, starts, ranks, own_ties, tie_sums, stride)
+
+    blocks = [(i, min(i + chunk, n_groups)) for i in range(0, n_groups, chunk)]
+    if workers == 1 or len(blocks) == 1:
+        _init_mann_whitney(*state)
+        parts = [_mann_whitney_rows(*block) for block in blocks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_mann_whitney, initargs=state) as pool:
+            parts = list(pool.map(_mann_whitney_rows, *zip(*blocks)))
+    a, b, u, ties = (np.concatenate(col) for col in zip(*parts))
+
+    n = starts[1:] - starts[:-1]
+    n1, n2 = n[a].astype(float), n[b].astype(float)
+    total = n1 + n2
+    mu = n1 * n2 / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = np.sqrt(n1 * n2 / 12 * ((total + 1) - ties / (total * (total - 1))))
+        z = (np.maximum(u, n1 * n2 - u) - mu - 0.5) / s
+    p = np.clip(2 * stats.norm.sf(z), 0, 1)
+    return a, b, u, p
+
+
+def run_battery(data, workers=None, alpha=0.05):
+    """Per-ticker tests plus every pairwise comparison, as one tidy table with FDR-adjusted p-values."""
+    codes, tickers = pd.factorize(data['ticker'], sort=True)
+    tickers = np.asarray(tickers)
+    T = len(tickers)
+    frames = []
 
-OUTPUT_TEMPLATE = (
-    'Normality tests (D\'Agostino-Pearson):\n'
-    'GME volatility: {gme_norm:.3g}\n'
-    'OPEN volatility: {open_norm:.3g}\n'
-    'Equal variance test (Levene): {levene_p:.3g}\n'
-    'Volatility comparison (Mann-Whitney): {vol_mann:.3g}\n'
-    'Mentions comparison (Mann-Whitney): {mention_mann:.3g}\n'
-    'Correlations (Spearman):\n'
-    'GME mentions-volatility: r={gme_corr:.3f}, p={gme_corr_p:.3g}\n'
-    'OPEN mentions-volatility: r={open_corr:.3f}, p={open_corr_p:.3g}\n'
-    'Activity levels ANOVA: F={anova_f:.3f}, p={anova_p:.3g}'
-)
-
-def main():
-    os.makedirs('stats', exist_ok=True)
-    
-    data = pd.read_csv('merge_cleaned/dataset.csv')
-    gme = data[data['ticker'] == 'GME']
-    open_data = data[data['ticker'] == 'OPEN']
-    
     # normality test
-    # Is volatility data normally distributed? 
+    # Is each ticker's volatility normally distributed?
     # H0: Data follows a normal distribution
     # H1: Data does not follow a normal distribution
-    gme_norm = stats.normaltest(gme['vol_5d'].dropna()).pvalue
-    open_norm = stats.normaltest(open_data['vol_5d'].dropna()).pvalue
-    # result: data is not normally distributed
-
-    # Levene's test
-    # Question: Do both stocks have similar volatility spread?
-    # H0: GME and OPEN have equal variances in volatility
-    # H1: GME and OPEN have different variances in volatility
-    levene_p = stats.levene(gme['vol_5d'].dropna(), open_data['vol_5d'].dropna()).pvalue
-    # result: data has different volatility variances
-
-    # mann-whitney u test
-    # Question: Does one stock tend to be more volatile than the other?
-    # H0: GME and OPEN volatility distributions are identical
-    # H1: GME and OPEN have significantly different volatility distributions
-    vol_mann = stats.mannwhitneyu(gme['vol_5d'].dropna(), open_data['vol_5d'].dropna()).pvalue
-    # result: GME is more volatile than OPEN
-
-    # Question: Does one stock get mentioned significantly more than the other?
-    # H0: GME and OPEN mention count distributions are identical  
-    # H1: GME and OPEN have significantly different mention patterns
-    mention_mann = stats.mannwhitneyu(gme['mention_count'], open_data['mention_count']).pvalue
-    # result: GME is mentioned more than OPEN
+    vol = data['vol_5d'].to_numpy(dtype=float)
+    has_vol = ~np.isnan(vol)
+    n, _, m2, m3, m4 = grouped_moments(vol[has_vol], codes[has_vol], T)
+    k2, p = normaltest(n, m2, m3, m4)
+    frames.append(pd.DataFrame({'test': 'normality', 'metric': 'vol_5d', 'ticker_a': tickers, 'n_a': n.astype(int), 'statistic': k2, 'p_value': p}))
 
     # spearman correlation
-    # Question: Do more Reddit mentions predict higher volatility for each stock?
+    # Question: Do more Reddit mentions go with higher volatility for each stock?
     # H0: No correlation between mentions and volatility (ρ = 0)
     # H1: There is a correlation between mentions and volatility (ρ ≠ 0)
-    gme_corr, gme_corr_p = stats.spearmanr(gme['mention_count'], gme['vol_5d'])
-    open_corr, open_corr_p = stats.spearmanr(open_data['mention_count'], open_data['vol_5d'])
-    # result: both show significant positive correlations, but OPEN’s correlation is stronger than GME’s
+    mentions = data['mention_count'].to_numpy(dtype=float)
+    n, r, p = grouped_spearman(mentions[has_vol], vol[has_vol], codes[has_vol], T)
+    frames.append(pd.DataFrame({'test': 'spearman', 'metric': 'mention_count~vol_5d', 'ticker_a': tickers, 'n_a': n.astype(int), 'statistic': r, 'p_value': p}))
+
+    for metric in PAIR_METRICS:
+        values = data[metric].to_numpy(dtype=float)
+        keep = ~np.isnan(values)
+        counts = np.bincount(codes[keep], minlength=T)
+
+        # Levene's test
+        # Question: Do both stocks have similar spread?
+        # H0: the two tickers have equal variances
+        # H1: the two tickers have different variances
+        a, b, w, p = pairwise_levene(values[keep], codes[keep], T)
+        frames.append(pd.DataFrame({'test': 'levene', 'metric': metric, 'ticker_a': tickers[a], 'ticker_b': tickers[b],
+                                    'n_a': counts[a], 'n_b': counts[b], 'statistic': w, 'p_value': p}))
+
+        # mann-whitney u test
+        # Question: Does one stock tend to be more volatile / more mentioned than the other?
+        # H0: the two tickers' distributions are identical
+        # H1: the two tickers have significantly different distributions
+        a, b, u, p = pairwise_mann_whitney(values[keep], codes[keep], T, workers=workers)
+        frames.append(pd.DataFrame({'test': 'mann_whitney', 'metric': metric, 'ticker_a': tickers[a], 'ticker_b': tickers[b],
+                                    'n_a': counts[a], 'n_b': counts[b], 'statistic': u, 'p_value': p}))
+
+    # benjamini-hochberg within each test/metric family, since there are up to T*(T-1)/2 tests in one
+    # reference: https://www.statsmodels.org/stable/generated/statsmodels.stats.multitest.multipletests.html
+    results = pd.concat(frames, ignore_index=True)
+    results['p_adj'] = np.nan
+    for _, idx in results.groupby(['test', 'metric']).groups.items():
+        p = results.loc[idx, 'p_value']
+        ok = p.notna()
+        if ok.any():
+            results.loc[p[ok].index, 'p_adj'] = multipletests(p[ok], alpha=alpha, method='fdr_bh')[1]
+    results['significant'] = results['p_adj'] < alpha
+    return results[RESULT_COLS]
+
+
+def main(tickers=None, workers=None):
+    os.makedirs('stats', exist_ok=True)
+
+    data = read_table('merge_cleaned/dataset', columns=['vol_5d', 'mention_count'], tickers=tickers)
+    with section('statistical_tests.battery', rows=len(data)):
+        results = run_battery(data, workers=workers)
+
+    # print results
+    n_tickers = data['ticker'].nunique()
+    print(f'{n_tickers} tickers, {n_tickers * (n_tickers - 1) // 2} pairs')
+    per_ticker = results[results['ticker_b'].isna()]
+    print(per_ticker.pivot(index='ticker_a', columns='test', values=['statistic', 'p_value']).to_string())
+    summary = results.groupby(['test', 'metric'])['significant'].agg(['size', 'sum'])
+    summary.columns = ['tests', 'significant (FDR 5%)']
+    print(summary.to_string())
 
     # anova one-way
-    # Question: Does the level of Reddit activity predict volatility across both stocks?
+    # Question: Does the level of Reddit activity predict volatility across all stocks?
     # H0: All activity levels (none/low/medium/high mentions) have equal mean volatility
     # H1: At least one activity level has significantly different mean volatility
-    data['activity_level'] = pd.cut(data['mention_count'], 
+    data['activity_level'] = pd.cut(data['mention_count'],
                                     bins=[-0.1, 0, 5, 20, float('inf')],
                                     labels=['none', 'low', 'medium', 'high'])
-    
-    groups = [group['vol_5d'].dropna() for name, group in data.groupby('activity_level')]
-    anova_f, anova_p = stats.f_oneway(*groups)
-    # result: At least one activity level has a significantly different mean volatility
 
-    # print results
-    print(OUTPUT_TEMPLATE.format(
-        gme_norm=gme_norm,
-        open_norm=open_norm,
-        levene_p=levene_p,
-        vol_mann=vol_mann,
-        mention_mann=mention_mann,
-        gme_corr=gme_corr,
-        gme_corr_p=gme_corr_p,
-        open_corr=open_corr,
-        open_corr_p=open_corr_p,
-        anova_f=anova_f,
-        anova_p=anova_p
-    ))
-    
-    # save results
-    results = pd.DataFrame({
-        'test': ['gme_normality', 'open_normality', 'volatility_levene', 
-                 'volatility_mann_whitney', 'mentions_mann_whitney', 
-                 'gme_correlation', 'open_correlation', 'activity_anova'],
-        'p_value': [gme_norm, open_norm, levene_p, vol_mann, mention_mann, 
-                    gme_corr_p, open_corr_p, anova_p],
-        'significant': [p < 0.05 for p in [gme_norm, open_norm, levene_p, 
-                                           vol_mann, mention_mann, gme_corr_p, 
-                                           open_corr_p, anova_p]]
-    })
-    results.to_csv('stats/stats_results.csv', index=False)
+    groups = [group['vol_5d'].dropna() for name, group in data.groupby('activity_level', observed=True)]
+    anova_f, anova_p = stats.f_oneway(*groups)
+    print(f'Activity levels ANOVA: F={anova_f:.3f}, p={anova_p:.3g}')
+    # one test, so p_adj is p itself
+    extra = [pd.DataFrame({'test': ['activity_anova'], 'metric': 'vol_5d', 'n_a': sum(len(g) for g in groups),
+                           'statistic': anova_f, 'p_value': anova_p, 'p_adj': anova_p, 'significant': anova_p < 0.05})]
 
     # tukey post-hoc test (only if anova is significant)
     # Question: Which specific activity levels differ from each other?
     # H0: No difference between specific pairs of activity levels
-    # H1: Significant difference between specific pairs 
+    # H1: Significant difference between specific pairs
     if anova_p < 0.05:
         tukey_data = data[['vol_5d', 'activity_level']].dropna()
         tukey = pairwise_tukeyhsd(tukey_data['vol_5d'], tukey_data['activity_level'])
         tukey_df = pd.DataFrame(data=tukey.summary().data[1:], columns=tukey.summary().data[0])
         tukey_df.to_csv('stats/tukey_results.csv', index=False)
+        # one row per pair of activity levels (in the ticker columns), statistic is the mean difference
+        # and p_adj / significant are tukey's own family-wise adjusted p-value and reject flag
+        sizes = tukey_data['activity_level'].value_counts()
+        extra.append(pd.DataFrame({'test': 'tukey_hsd', 'metric': 'vol_5d',
+                                   'ticker_a': tukey_df['group1'].astype(str), 'ticker_b': tukey_df['group2'].astype(str),
+                                   'n_a': tukey_df['group1'].map(sizes).to_numpy(), 'n_b': tukey_df['group2'].map(sizes).to_numpy(),
+                                   'statistic': tukey.meandiffs, 'p_value': tukey.pvalues, 'p_adj': tukey.pvalues,
+                                   'significant': tukey.reject}))
+
+    results = pd.concat([results] + extra, ignore_index=True)[RESULT_COLS]
+    results.to_csv('stats/stats_results.csv', index=False)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    # defaults to every ticker in the dataset
+    parser.add_argument('--tickers', nargs='+')
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+    with profile_stage('statistical_tests'):
+        main(tickers=args.tickers, workers=args.workers)
@@ -0,0 +1,117 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+
+# every pipeline stage output is a parquet dataset (a folder) partitioned by ticker, with
+# rows sorted by date so parquet's row group stats let date filters skip data too
+# reference: https://pandas.pydata.org/docs/reference/api/pandas.DataFrame.to_parquet.html
+# reference: https://arrow.apache.org/docs/python/parquet.html#partitioned-datasets-multiple-files
+
+# columns parsed as dates when falling back to an old csv
+DATE_COLS = ['Date', 'date', 'Datetime']
+
+
+def _date_col(df):
+    return next((c for c in DATE_COLS if c in df.columns), None)
+
+
+def write_table(df, name, partition_col='ticker', mode='overwrite', csv=False):
+    """Write a stage output to `name/` as parquet.
+
+    mode='overwrite' replaces the whole dataset, 'replace' only the tickers present in `df`
+    and 'append' adds new files next to the existing ones. With csv=True the full table is
+    also exported to `name.csv` like the old pipeline.
+    """
+    date_col = _date_col(df)
+    if date_col is not None:
+        df = df.sort_values([partition_col, date_col])
+    if mode == 'overwrite' and os.path.exists(name):
+        shutil.rmtree(name)
+    elif mode == 'replace':
+        for value in df[partition_col].unique():
+            shutil.rmtree(os.path.join(name, f'{partition_col}={value}'), ignore_errors=True)
+    os.makedirs(name, exist_ok=True)
+    df.to_parquet(name, partition_cols=[partition_col], compression='zstd', index=False)
+
+    if csv:
+        read_table(name).to_csv(name + '.csv', index=False)
+
+
+def read_table(name, columns=None, tickers=None, start=None, end=None, partition_col='ticker'):
+    """Load a stage output, only reading the requested columns, tickers and date range.
+
+    The ticker and date filters are pushed down to parquet, so skipped partitions and
+    row groups are never read. Rows come back sorted by ticker and date. Falls back to
+    `name.csv` when there is no parquet dataset yet.
+    """
+    if not os.path.isdir(name):
+        return _read_csv(name + '.csv', columns, tickers, start, end, partition_col)
+
+    filters = []
+    if tickers is not None:
+        filters.append((partition_col, 'in', list(tickers)))
+    if start is not None or end is not None:
+        # only the schema is read here, not the data
+        date_col = _date_col(pd.DataFrame(columns=ds.dataset(name, partitioning='hive').schema.names))
+    if start is not None:
+        filters.append((date_col, '>=', pd.Timestamp(start)))
+    if end is not None:
+        filters.append((date_col, '<=', pd.Timestamp(end)))
+
+    # the partition column isn't stored inside the files, ask for it explicitly
+    if columns is not None and partition_col not in columns:
+        columns = list(columns) + [partition_col]
+    df = pd.read_parquet(name, columns=columns, filters=filters or None)
+    # partition values come back as a category, turn them back into plain strings
+    df[partition_col] = df[partition_col].astype(str)
+    return _sorted_by_date(df, partition_col)
+
+
+def _sorted_by_date(df, partition_col):
+    """Rows in (partition, date) order.
+
+    Files inside a partition are read in name order, and files added with mode='append' have
+    random names, so appended rows can come back before older ones. Sorting is skipped when the
+    rows are already in order (one O(n) check), which is the case without appends.
+    """
+    date_col = _date_col(df)
+    if date_col is None or len(df) < 2:
+        return df.reset_index(drop=True)
+    codes, _ = pd.factorize(df[partition_col], sort=True)
+    dates = df[date_col].to_numpy(dtype='datetime64[ns]').view('int64')
+    in_order = (codes[1:] > codes[:-1]) | ((codes[1:] == codes[:-1]) & (dates[1:] >= dates[:-1]))
+    if in_order.all():
+        return df.reset_index(drop=True)
+    return df.iloc[np.lexsort((dates, codes))].reset_index(drop=True)
+
+
+def _read_csv(path, columns, tickers, start, end, partition_col):
+    usecols = None if columns is None else list(dict.fromkeys(list(columns) + [partition_col]))
+    df = pd.read_csv(path, usecols=usecols)
+    date_col = _date_col(df)
+    if date_col is not None:
+        df[date_col] = pd.to_datetime(df[date_col])
+    if tickers is not None:
+        df = df[df[partition_col].isin(list(tickers))]
+    if start is not None:
+        df = df[df[date_col] >= pd.Timestamp(start)]
+    if end is not None:
+        df = df[df[date_col] <= pd.Timestamp(end)]
+    return _sorted_by_date(df, partition_col)
+
+
+def list_partitions(name, partition_col='ticker'):
+    """Partition values (e.g. tickers) present in a dataset, without reading any data."""
+    if not os.path.isdir(name):
+        return sorted(read_table(name, columns=[partition_col])[partition_col].unique())
+    prefix = partition_col + '='
+    return sorted(d[len(prefix):] for d in os.listdir(name) if d.startswith(prefix))
+
+
+def table_size(name):
+    """Bytes on disk for a parquet dataset folder or a single file."""
+    if os.path.isfile(name):
+        return os.path.getsize(name)
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(name) for f in files)
@@ -0,0 +1,84 @@
+import sqlite3
+import pandas as pd
+
+# every scraped post/comment, keyed by (reddit id, ticker) so reruns can append without duplicating
+# reference: https://docs.python.org/3/library/sqlite3.html
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS records (
+    id TEXT NOT NULL,
+    ticker TEXT NOT NULL,
+    submission_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    date TEXT NOT NULL,
+    created_utc REAL NOT NULL,
+    score INTEGER,
+    num_comments INTEGER,
+    sentiment REAL,
+    PRIMARY KEY (id, ticker)
+);
+CREATE INDEX IF NOT EXISTS records_ticker_date ON records (ticker, date);
+CREATE TABLE IF NOT EXISTS watermarks (
+    ticker TEXT PRIMARY KEY,
+    created_utc REAL NOT NULL
+);
+'''
+
+RECORD_COLS = ['id', 'ticker', 'submission_id', 'type', 'date', 'created_utc', 'score', 'num_comments', 'sentiment']
+
+
+class RedditStore:
+    """Persistent local store of scraped Reddit records.
+
+    Rows are committed one scored batch at a time (whole submissions, `score_batch` rows
+    or so), so a crashed scrape loses at most the batch in flight and the rerun fetches
+    those submissions again. The per-ticker high-water mark (newest post of the last fully
+    stored listing) lets reruns only look at new submissions.
+    """
+
+    def __init__(self, path='scrape_stock/reddit.db'):
+        self.conn = sqlite3.connect(path)
+        # WAL keeps the per-batch commits cheap
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+
+    def known_submissions(self, ticker):
+        rows = self.conn.execute(
+            "SELECT submission_id FROM records WHERE ticker = ? AND type = 'post'", (ticker,))
+        return {r[0] for r in rows}
+
+    def watermark(self, ticker):
+        row = self.conn.execute('SELECT created_utc FROM watermarks WHERE ticker = ?', (ticker,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, rows):
+        """Append one scored batch of rows (whole submissions with their comments) and commit it as a checkpoint."""
+        with self.conn:
+            self.conn.executemany(
+                f'INSERT OR IGNORE INTO records ({", ".join(RECORD_COLS)}) '
+                f'VALUES ({", ".join("?" * len(RECORD_COLS))})',
+                [tuple(row[c] for c in RECORD_COLS) for row in rows])
+
+    def advance_watermarks(self, newest):
+        """Move each ticker's high-water mark up to `newest` ({ticker: created_utc}).
+
+        Only call this once every submission of the tickers' listings is stored: comment trees
+        finish out of order, so a mark moved mid-scrape could hide older posts that were never fetched.
+        """
+        with self.conn:
+            self.conn.executemany(
+                'INSERT INTO watermarks (ticker, created_utc) VALUES (?, ?) '
+                'ON CONFLICT(ticker) DO UPDATE SET created_utc = max(created_utc, excluded.created_utc)',
+                list(newest.items()))
+
+    def raw(self):
+        return pd.read_sql_query(f'SELECT {", ".join(RECORD_COLS)} FROM records ORDER BY ticker, created_utc', self.conn)
+
+    def daily(self):
+        # same daily rollup as the old groupby(['date', 'ticker']), done inside sqlite
+        return pd.read_sql_query(
+            'SELECT date, ticker, AVG(sentiment) AS avg_sentiment, COUNT(sentiment) AS mention_count '
+            'FROM records GROUP BY date, ticker ORDER BY date, ticker', self.conn)
+
+    def close(self):
+        self.conn.close()
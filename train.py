@@ -1,4 +1,16 @@
 import pandas as pd
+import numpy as np
+import argparse
+import joblib
+import json
+import multiprocessing
+import os
+import sklearn
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from sklearn.base import clone
+from sklearn.model_selection import ParameterGrid
 from sklearn.preprocessing import StandardScaler
 from sklearn.linear_model import LogisticRegression
 from sklearn.naive_bayes import GaussianNB
@@ -6,6 +18,9 @@ from sklearn.ensemble import RandomForestClassifier
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.neural_network import MLPClassifier
 from sklearn.pipeline import make_pipeline
+from leadlag import add_lag_features
+from profiling import profile_stage, section
+from storage import read_table
 
 OUTPUT_TEMPLATE = (
     'Logistic Regression (acc): {log_acc:.3f}\n'
@@ -15,10 +30,172 @@ OUTPUT_TEMPLATE = (
     'ANN (acc): {ann_acc:.3f}\n'
 )
 
-def main():
-    data = pd.read_csv('merge_cleaned/dataset.csv')
-    data['Date'] = pd.to_datetime(data['Date'])
-    feature_cols = ['avg_sentiment', 'mention_count']
+# training models
+# reference: https://ggbaker.ca/data-science/content/ml.html
+# reference: https://medium.com/@ssadullah.celik/comparing-machine-learning-algorithms-in-python-logistic-regression-svm-knn-neural-networks-6aa6a551ab30
+MODELS = {
+    'logistic': make_pipeline(StandardScaler(), LogisticRegression()),
+    'naive_bayes': make_pipeline(StandardScaler(), GaussianNB()),
+    'random_forest': RandomForestClassifier(n_estimators=100, random_state=42),
+    'knn': make_pipeline(StandardScaler(), KNeighborsClassifier(n_neighbors=5)),
+    'ann': make_pipeline(StandardScaler(), MLPClassifier(max_iter=1000)),
+}
+
+# hyperparameters tried by the evaluation harness (an empty grid just runs the defaults above)
+PARAM_GRIDS = {
+    'logistic': {'logisticregression__C': [0.1, 1.0, 10.0]},
+    'naive_bayes': {},
+    'random_forest': {'n_estimators': [100, 300], 'max_depth': [None, 5]},
+    'knn': {'kneighborsclassifier__n_neighbors': [5, 15, 31]},
+    'ann': {'mlpclassifier__hidden_layer_sizes': [(100,), (32, 16)]},
+}
+
+
+# fitted models are saved as models/<name>/<version>/ and models/<name>/LATEST names the newest
+MODEL_DIR = 'models'
+
+
+def save_model(model, name, feature_cols, metrics):
+    """Save a fitted model with its metadata as a new version and point LATEST at it."""
+    # reference: https://scikit-learn.org/stable/model_persistence.html
+    version = datetime.now().strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(MODEL_DIR, name, version)
+    suffix = 1
+    while os.path.exists(path):
+        suffix += 1
+        path = os.path.join(MODEL_DIR, name, f'{version}-{suffix}')
+    os.makedirs(path)
+    joblib.dump(model, os.path.join(path, 'model.joblib'))
+    meta = {
+        'name': name,
+        'version': os.path.basename(path),
+        'feature_cols': feature_cols,
+        'metrics': metrics,
+        'trained_at': datetime.now().isoformat(timespec='seconds'),
+        'sklearn_version': sklearn.__version__,
+    }
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    with open(os.path.join(MODEL_DIR, name, 'LATEST'), 'w') as f:
+        f.write(meta['version'])
+    return path
+
+
+# same-day reddit activity, plus <col>_lag1..<col>_lagN of it when --lags N is given
+FEATURE_COLS = ['avg_sentiment', 'mention_count']
+
+
+def load_dataset(lags=0):
+    """The training rows and feature columns, with `lags` days of lagged reddit activity added."""
+    feature_cols = list(FEATURE_COLS)
+    data = read_table('merge_cleaned/dataset', columns=['Date', 'high_vol'] + feature_cols)
+    if lags:
+        data, lag_cols = add_lag_features(data, FEATURE_COLS, range(1, lags + 1))
+        # the first days of each ticker have no history to lag
+        data = data.dropna(subset=lag_cols).reset_index(drop=True)
+        feature_cols += lag_cols
+    return data, feature_cols
+
+
+def walk_forward_splits(data, n_splits=5, min_train=0.5):
+    """Expanding-window folds made per ticker and then combined.
+
+    For every ticker the first `min_train` share of its days is always training data and
+    the rest is cut into `n_splits` blocks; fold k tests on block k after training on all
+    earlier days, so a model never sees the future of the ticker it is scored on.
+    reference: https://scikit-learn.org/stable/modules/generated/sklearn.model_selection.TimeSeriesSplit.html
+    """
+    data = data.reset_index(drop=True)
+    folds = [([], []) for _ in range(n_splits)]
+    # sorted once, each ticker's rows are then a lookup into the sorted index
+    ordered = data.sort_values('Date')
+    for _, idx in ordered.groupby('ticker', sort=False).indices.items():
+        rows = ordered.index[idx]
+        bounds = np.linspace(int(len(rows) * min_train), len(rows), n_splits + 1).astype(int)
+        for k in range(n_splits):
+            folds[k][0].extend(rows[:bounds[k]])
+            folds[k][1].extend(rows[bounds[k]:bounds[k + 1]])
+    return [(np.array(train), np.array(test)) for train, test in folds if len(train) and len(test)]
+
+
+# the dataset is sent to each worker process once instead of with every task
+_worker_data = None
+
+
+def _init_worker(data):
+    global _worker_data
+    _worker_data = data
+
+
+def _rss_mb(field):
+    # reference: https://man7.org/linux/man-pages/man5/proc.5.html (VmRSS / VmHWM in /proc/self/status)
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return np.nan
+
+
+def _reset_peak_rss():
+    # writing 5 to clear_refs resets VmHWM (the peak RSS) so it only covers what runs next
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def evaluate_model(name, params, feature_cols, splits):
+    """Fit and score one model/parameter combination on every fold, timing it as it goes."""
+    X = _worker_data[feature_cols].to_numpy()
+    y = _worker_data['high_vol'].to_numpy()
+    model = clone(MODELS[name]).set_params(**params)
+    # peak RSS above what the worker already used before this model (linux only, NaN elsewhere)
+    _reset_peak_rss()
+    rss_before = _rss_mb('VmRSS')
+    fit_time = predict_time = 0.0
+    scores = []
+    for train_idx, test_idx in splits:
+        # a fold without both classes can't be fit
+        if len(np.unique(y[train_idx])) < 2:
+            continue
+        start = time.perf_counter()
+        model.fit(X[train_idx], y[train_idx])
+        fit_time += time.perf_counter() - start
+        start = time.perf_counter()
+        pred = model.predict(X[test_idx])
+        predict_time += time.perf_counter() - start
+        scores.append((pred == y[test_idx]).mean())
+    return {
+        'model': name,
+        'params': str(params),
+        'folds': len(scores),
+        'accuracy': np.mean(scores) if scores else np.nan,
+        'accuracy_std': np.std(scores) if scores else np.nan,
+        'fit_s': fit_time,
+        'predict_s': predict_time,
+        'peak_mem_mb': _rss_mb('VmHWM') - rss_before,
+    }
+
+
+def evaluate(data, feature_cols, models=None, n_splits=5, workers=None):
+    """Run every model and grid point over walk-forward folds in parallel worker processes."""
+    splits = walk_forward_splits(data, n_splits=n_splits)
+    tasks = [(name, params) for name in (models or MODELS) for params in ParameterGrid(PARAM_GRIDS.get(name, {}))]
+    # reference: https://docs.python.org/3/library/concurrent.futures.html#processpoolexecutor
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=(data.reset_index(drop=True),)) as pool:
+        futures = [pool.submit(evaluate_model, name, params, feature_cols, splits) for name, params in tasks]
+        results = pd.DataFrame([f.result() for f in futures])
+    return results.sort_values(['accuracy', 'fit_s'], ascending=[False, True]).reset_index(drop=True)
+
+
+def main(lags=0):
+    os.makedirs('stats', exist_ok=True)
+    data, feature_cols = load_dataset(lags)
     
     # uses history to predict future
     # splits the data into start to middle of date range as history (train) and middle of date range to end as future (test)
@@ -32,23 +209,18 @@ def main():
     train = pd.concat(train)
     test = pd.concat(test)
 
-    X_train = train[feature_cols]
-    y_train = train['high_vol']
-    X_test = test[feature_cols]
-    y_test = test['high_vol']
+    # plain arrays so the saved models can score arrays without feature name checks
+    X_train = train[feature_cols].to_numpy()
+    y_train = train['high_vol'].to_numpy()
+    X_test = test[feature_cols].to_numpy()
+    y_test = test['high_vol'].to_numpy()
 
-    # training models
-    # reference: https://ggbaker.ca/data-science/content/ml.html
-    # reference: https://medium.com/@ssadullah.celik/comparing-machine-learning-algorithms-in-python-logistic-regression-svm-knn-neural-networks-6aa6a551ab30
-    logistic = make_pipeline(StandardScaler(), LogisticRegression())
-    nb = make_pipeline(StandardScaler(), GaussianNB())
-    rf = RandomForestClassifier(n_estimators=100, random_state=42)
-    knn = make_pipeline(StandardScaler(), KNeighborsClassifier(n_neighbors=5))
-    ann = make_pipeline(StandardScaler(), MLPClassifier(max_iter=1000))
+    logistic, nb, rf, knn, ann = (clone(MODELS[name]) for name in ('logistic', 'naive_bayes', 'random_forest', 'knn', 'ann'))
 
     # fit
-    for m in (logistic, nb, rf, knn, ann):
-        m.fit(X_train, y_train)
+    for name, m in zip(('logistic', 'naive_bayes', 'random_forest', 'knn', 'ann'), (logistic, nb, rf, knn, ann)):
+        with section(f'train.fit.{name}', rows=len(X_train)):
+            m.fit(X_train, y_train)
 
     # accuracy of each model
     log_acc = logistic.score(X_test, y_test)
@@ -61,11 +233,39 @@ def main():
         log_acc=log_acc, nb_acc=nb_acc, rf_acc=rf_acc, knn_acc=knn_acc, ann_acc=ann_acc
     ))
 
+    # keep the fitted models so new days can be scored with predict.py without refitting
+    fitted = {'logistic': (logistic, log_acc), 'naive_bayes': (nb, nb_acc), 'random_forest': (rf, rf_acc),
+              'knn': (knn, knn_acc), 'ann': (ann, ann_acc)}
+    for name, (model, acc) in fitted.items():
+        save_model(model, name, feature_cols, {'test_accuracy': acc, 'train_rows': len(X_train), 'test_rows': len(X_test)})
+
     # random forest was seen to be the best model
     rf_pred = rf.predict(X_test)
     out = test[['Date', 'ticker', 'high_vol']].copy()
     out['predicted'] = rf_pred
     out.to_csv('stats/predictions.csv', index=False)
 
+def main_evaluate(n_splits=5, workers=None, lags=0):
+    os.makedirs('stats', exist_ok=True)
+    data, feature_cols = load_dataset(lags)
+    # model fits run in the worker processes, their times are in the results table
+    with section('train.evaluate', rows=len(data)):
+        results = evaluate(data, feature_cols, n_splits=n_splits, workers=workers)
+    print(results.to_string(index=False))
+    results.to_csv('stats/model_eval.csv', index=False)
+
+
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    # compare every model and grid point with walk-forward cross-validation instead of the single split
+    parser.add_argument('--evaluate', action='store_true')
+    parser.add_argument('--splits', type=int, default=5)
+    parser.add_argument('--workers', type=int)
+    # also use mention_count/avg_sentiment from the previous N trading days (see leadlag.py)
+    parser.add_argument('--lags', type=int, default=0)
+    args = parser.parse_args()
+    with profile_stage('train'):
+        if args.evaluate:
+            main_evaluate(n_splits=args.splits, workers=args.workers, lags=args.lags)
+        else:
+            main(lags=args.lags)
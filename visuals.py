@@ -1,62 +1,93 @@
 import pandas as pd
+import numpy as np
+import matplotlib
+import matplotlib.dates as mdates
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import multiprocessing
 import os
+from profiling import profile_stage, section
+from storage import list_partitions, read_table
 
-def create_simple_plots():
+# reddit activity levels, same bins as the ANOVA in statistical_tests.py
+ACTIVITY_BINS = [-0.1, 0, 5, 20, float('inf')]
+ACTIVITY_LABELS = ['None', 'Low', 'Medium', 'High']
+# time series longer than this are downsampled before drawing
+MAX_POINTS = 2000
+# tickers drawn per worker task
+TICKER_CHUNK = 20
+
+
+def activity_groups(dataset):
+    """vol_5d of every row grouped by reddit activity level, in ACTIVITY_LABELS order."""
+    data = dataset.dropna(subset=['vol_5d'])
+    level = pd.cut(data['mention_count'], bins=ACTIVITY_BINS, labels=ACTIVITY_LABELS).cat.codes.to_numpy()
+    # a stable sort by level keeps each group's rows in their original order
+    order = np.argsort(level, kind='stable')
+    bounds = np.cumsum(np.bincount(level, minlength=len(ACTIVITY_LABELS)))[:-1]
+    return np.split(data['vol_5d'].to_numpy()[order], bounds)
+
+
+def downsample(x, y, max_points=MAX_POINTS):
+    """Keep the min and max of y in each of max_points / 2 buckets, so spikes still show."""
+    y = np.asarray(y, dtype=float)
+    if len(y) <= max_points:
+        return x, y
+    n_buckets = max_points // 2
+    size = -(-len(y) // n_buckets)
+    padded = np.full(n_buckets * size, np.nan)
+    padded[:len(y)] = y
+    buckets = padded.reshape(n_buckets, size)
+    start = np.arange(n_buckets) * size
+    lows = start + np.argmin(np.where(np.isnan(buckets), np.inf, buckets), axis=1)
+    highs = start + np.argmax(np.where(np.isnan(buckets), -np.inf, buckets), axis=1)
+    keep = np.unique(np.concatenate([lows, highs]))
+    keep = keep[keep < len(y)]
+    keep = keep[~np.isnan(y[keep])]
+    return np.asarray(x)[keep], y[keep]
+
+
+def finish(path, show):
+    with section('visuals.save'):
+        plt.savefig(path)
+    if show:
+        plt.show()
+    plt.close()
+
+
+def create_simple_plots(show=True):
     os.makedirs('visuals', exist_ok=True)
-    dataset = pd.read_csv('merge_cleaned/dataset.csv')
-    dataset['Date'] = pd.to_datetime(dataset['Date'])
-    
+    dataset = read_table('merge_cleaned/dataset', columns=['Date', 'vol_5d', 'mention_count', 'avg_sentiment'])
+
     # plot 1: time series
     # reference: https://machinelearningmastery.com/time-series-data-visualization-with-python/
     fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(12, 8))
-    
+
     # GME plot
     gme_data = dataset[dataset['ticker'] == 'GME']
-    ax1.plot(gme_data['Date'], gme_data['vol_5d'], color='blue')
+    ax1.plot(*downsample(gme_data['Date'], gme_data['vol_5d']), color='blue')
     ax1.set_title('GME: Volatility Over Time')
     ax1.set_ylabel('Volatility')
-    
+
     # OPEN plot
     open_data = dataset[dataset['ticker'] == 'OPEN']
-    ax2.plot(open_data['Date'], open_data['vol_5d'], color='orange')
+    ax2.plot(*downsample(open_data['Date'], open_data['vol_5d']), color='orange')
     ax2.set_title('OPEN: Volatility Over Time')
     ax2.set_ylabel('Volatility')
     ax2.set_xlabel('Date')
-    plt.savefig('visuals/timeseries.png')
-    plt.show()
-    
+    finish('visuals/timeseries.png', show)
+
     # plot 2: box plot
     # reference: https://matplotlib.org/stable/api/_as_gen/matplotlib.pyplot.boxplot.html
+    # reference: https://pandas.pydata.org/docs/reference/api/pandas.cut.html
     plt.figure(figsize=(8, 6))
-    none_vol = []
-    low_vol = []
-    medium_vol = []
-    high_vol = []
-    
-    for i in range(len(dataset)):
-        mentions = dataset.iloc[i]['mention_count']
-        vol = dataset.iloc[i]['vol_5d']
-        
-        if pd.isna(vol):
-            continue
-            
-        if mentions == 0:
-            none_vol.append(vol)
-        elif mentions <= 5:
-            low_vol.append(vol)
-        elif mentions <= 20:
-            medium_vol.append(vol)
-        else:
-            high_vol.append(vol)
-            
-    plt.boxplot([none_vol, low_vol, medium_vol, high_vol], labels=['None', 'Low', 'Medium', 'High'])
+    plt.boxplot(activity_groups(dataset), tick_labels=ACTIVITY_LABELS)
     plt.title('Volatility by Reddit Activity Level')
     plt.xlabel('Activity Level')
     plt.ylabel('Volatility')
-    plt.savefig('visuals/boxplot.png')
-    plt.show()
-    
+    finish('visuals/boxplot.png', show)
+
     # plot 3: scatter plot
     # reference: https://matplotlib.org/stable/api/_as_gen/matplotlib.pyplot.scatter.html
     plt.figure(figsize=(10, 6))
@@ -69,9 +100,8 @@ def create_simple_plots():
     plt.xlabel('Average Sentiment')
     plt.ylabel('Volatility')
     plt.legend()
-    plt.savefig('visuals/scatterplot.png')
-    plt.show()
-    
+    finish('visuals/scatterplot.png', show)
+
     # plot 4: bar chart
     # reference: https://matplotlib.org/stable/api/_as_gen/matplotlib.pyplot.bar.html
     plt.figure(figsize=(8, 6))
@@ -85,8 +115,88 @@ def create_simple_plots():
     plt.ylim(0, 1)
     plt.text(0, gme_corr + 0.02, f'{gme_corr:.3f}', ha='center')
     plt.text(1, open_corr + 0.02, f'{open_corr:.3f}', ha='center')
-    plt.savefig('visuals/barchart.png')
-    plt.show()
+    finish('visuals/barchart.png', show)
+
+
+def plot_ticker(ticker, data, out_dir, max_points=MAX_POINTS):
+    """One figure with the four plots above for a single ticker, saved as out_dir/<ticker>.png."""
+    data = data.sort_values('Date')
+    fig, axes = plt.subplots(2, 2, figsize=(14, 9))
+    fig.suptitle(ticker)
+    # fixed margins instead of tight_layout, which costs another full draw per figure
+    fig.subplots_adjust(left=0.06, right=0.97, bottom=0.07, top=0.91, wspace=0.18, hspace=0.3)
+
+    ax = axes[0, 0]
+    ax.plot(*downsample(data['Date'], data['vol_5d'], max_points), color='blue', linewidth=0.8)
+    ax.set_title('Volatility Over Time')
+    ax.set_ylabel('Volatility')
+    ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(ax.xaxis.get_major_locator()))
+
+    ax = axes[0, 1]
+    ax.boxplot(activity_groups(data), tick_labels=ACTIVITY_LABELS)
+    ax.set_title('Volatility by Reddit Activity Level')
+    ax.set_xlabel('Activity Level')
+
+    ax = axes[1, 0]
+    active = data[data['mention_count'] > 0]
+    # rasterized so huge scatters don't blow up the file or the draw time
+    ax.scatter(active['avg_sentiment'], active['vol_5d'], s=8, color='orange', rasterized=True)
+    ax.set_title('Sentiment vs Volatility')
+    ax.set_xlabel('Average Sentiment')
+    ax.set_ylabel('Volatility')
+
+    ax = axes[1, 1]
+    ax.plot(*downsample(data['Date'], data['mention_count'], max_points), color='gray', linewidth=0.8)
+    corr = data['mention_count'].corr(data['vol_5d'])
+    ax.set_title(f'Reddit Mentions (corr with volatility {corr:.3f})')
+    ax.set_xlabel('Date')
+    ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(ax.xaxis.get_major_locator()))
+
+    fig.savefig(os.path.join(out_dir, f'{ticker}.png'))
+    plt.close(fig)
+
+
+def _plot_tickers(tickers, out_dir, max_points):
+    # each worker loads only its own tickers from the partitioned dataset
+    data = read_table('merge_cleaned/dataset', columns=['Date', 'vol_5d', 'mention_count', 'avg_sentiment'], tickers=tickers)
+    for ticker, group in data.groupby('ticker'):
+        plot_ticker(ticker, group, out_dir, max_points)
+    return len(tickers)
+
+
+def _init_headless():
+    matplotlib.use('Agg')
+
+
+def create_ticker_plots(tickers=None, out_dir='visuals/tickers', workers=None, max_points=MAX_POINTS, chunk=TICKER_CHUNK):
+    """Draw a figure set for every ticker (default: all of them) in parallel worker processes."""
+    os.makedirs(out_dir, exist_ok=True)
+    tickers = sorted(tickers or list_partitions('merge_cleaned/dataset'))
+    batches = [tickers[i:i + chunk] for i in range(0, len(tickers), chunk)]
+    # rows here are figures, drawn in the workers (their cpu shows up as children_cpu_s)
+    with section('visuals.ticker_plots', rows=len(tickers)):
+        if workers == 1 or len(batches) <= 1:
+            for batch in batches:
+                _plot_tickers(batch, out_dir, max_points)
+        else:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=_init_headless) as pool:
+                list(pool.map(_plot_tickers, batches, [out_dir] * len(batches), [max_points] * len(batches)))
+    print(f'{len(tickers)} ticker figures saved to {out_dir}')
 
 if __name__ == '__main__':
-    create_simple_plots()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    # draw to files only (Agg backend, no windows), for batch jobs
+    parser.add_argument('--headless', action='store_true')
+    # per-ticker figure sets; with no names, every ticker in the dataset
+    parser.add_argument('--tickers', nargs='*')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--max-points', type=int, default=MAX_POINTS)
+    args = parser.parse_args()
+    if args.headless:
+        matplotlib.use('Agg')
+    with profile_stage('visuals'):
+        if args.tickers is None:
+            create_simple_plots(show=not args.headless)
+        else:
+            create_ticker_plots(args.tickers, workers=args.workers, max_points=args.max_points)